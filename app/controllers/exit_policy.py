@@ -0,0 +1,89 @@
+"""
+    Helpers for working with the exit_policy_summary field of Onionoo relays.
+    Policies are turned into sorted lists of accepted port intervals, which are
+    used for the network-wide port histogram and for finding rare exit ports.
+"""
+
+MAX_PORT = 65535
+
+def parse_between(string):
+    """ Parses "80" or "79-81" into an inclusive (low, high) interval """
+    if "-" in string:
+        low, high = string.split("-")
+        return (int(low), int(high))
+    return (int(string), int(string))
+
+def allows_everything_or_nothing(exit_policy_summary):
+    """ True for policies that accept or reject the whole port range """
+    policy = exit_policy_summary.keys()[0]
+    return exit_policy_summary[policy][0] == "1-65535"
+
+def accepted_intervals(exit_policy_summary):
+    """
+        Returns the ports accepted by an exit_policy_summary as a sorted list of
+        non-overlapping, inclusive (low, high) intervals
+    """
+    if "accept" in exit_policy_summary:
+        policy = "accept"
+    else:
+        policy = "reject"
+
+    intervals = []
+    for low, high in sorted(parse_between(entry) for entry in exit_policy_summary[policy]):
+        if intervals and low <= intervals[-1][1] + 1:
+            intervals[-1] = (intervals[-1][0], max(high, intervals[-1][1]))
+        else:
+            intervals.append((low, high))
+
+    if policy == "accept":
+        return intervals
+
+    # Complement of the rejected intervals
+    accepted = []
+    start = 1
+    for low, high in intervals:
+        if low > start:
+            accepted.append((start, low - 1))
+        start = max(start, high + 1)
+    if start <= MAX_PORT:
+        accepted.append((start, MAX_PORT))
+    return accepted
+
+def port_histogram(relays):
+    """
+        Counts how many relays accept each port, skipping relays that accept or
+        reject every port. Returns a list indexed by port number (index 0 is unused)
+    """
+    # Difference array: +1 at the start of each interval, -1 after its end
+    diff = [0] * (MAX_PORT + 2)
+    for relay in relays:
+        if allows_everything_or_nothing(relay["exit_policy_summary"]):
+            continue
+        for low, high in accepted_intervals(relay["exit_policy_summary"]):
+            diff[low] += 1
+            diff[high + 1] -= 1
+
+    return prefix_counts(diff)
+
+def prefix_counts(diff):
+    """ Turns a port difference array into a list indexed by port number """
+    histogram = [0] * (MAX_PORT + 1)
+    count = 0
+    for port in range(1, MAX_PORT + 1):
+        count += diff[port]
+        histogram[port] = count
+    return histogram
+
+def rare_port_prefix(histogram, threshold):
+    """
+        Prefix sums over the ports accepted by at most threshold relays.
+        prefix[p] is the number of such ports below p
+    """
+    prefix = [0] * (MAX_PORT + 2)
+    for port in range(1, MAX_PORT + 1):
+        prefix[port + 1] = prefix[port] + (1 if histogram[port] <= threshold else 0)
+    return prefix
+
+def count_in_intervals(intervals, prefix):
+    """ Number of ports counted by prefix that fall inside the intervals """
+    return sum(prefix[high + 1] - prefix[low] for low, high in intervals)
@@ -0,0 +1,72 @@
+"""
+    NetworkStats computes the network-wide histograms that relay_rank.py ranks
+    families against, in a single pass over the relays:
+        - relay count and consensus weight fraction per country, for all, Exit and
+          Guard relays
+        - relay count per AS organization, for Exit and Guard relays
+        - number of relays accepting each port
+    The Exit and Guard relays are collected on the way. The results have the shapes
+    that record_country_stats, record_port_stats and the org histograms in the
+    groups dict expect.
+"""
+
+from app.controllers.exit_policy import accepted_intervals, allows_everything_or_nothing, prefix_counts, MAX_PORT
+from app.controllers.ranking_snapshot import COUNTRY_GROUPS
+
+# Relay subsets with their own org histograms
+ORG_GROUPS = ["Exit", "Guard"]
+
+def new_org_histogram(as_orgs):
+    """ Histogram of relays per org_id, starting at zero for every known org_id """
+    return {"org_2_hist": dict((org_id, 0) for org_id in as_orgs.org_ids)}
+
+class NetworkStats(object):
+
+    def __init__(self, as_orgs, histograms=True):
+        """
+            as_orgs is the AsOrgLookup the org histograms are built with.
+            With histograms=False only the Exit and Guard relays and the org histograms
+            are collected, e.g. when an incremental run updates the country and port
+            histograms from deltas instead
+        """
+        self.histograms = histograms
+        self.relays = dict((flag, []) for flag in ORG_GROUPS)
+        # group => (relay_count, cw_fraction) by upper case country code
+        self.countries = dict((group, ({}, {})) for group in COUNTRY_GROUPS)
+        self.as_orgs = as_orgs
+        self.orgs = dict((flag, new_org_histogram(as_orgs)) for flag in ORG_GROUPS)
+        # Difference array of accepted port intervals
+        self.port_diff = [0] * (MAX_PORT + 2)
+
+    def add_relays(self, relays):
+        for relay in relays:
+            self.add(relay)
+        return self
+
+    def add(self, relay):
+        groups = [flag for flag in ORG_GROUPS if relay.has_flag(flag)]
+        for flag in groups:
+            self.relays[flag].append(relay)
+            if "as_number" in relay:
+                org_id = self.as_orgs.org_id(relay["as_number"])
+                self.orgs[flag]["org_2_hist"][org_id] = self.orgs[flag]["org_2_hist"].get(org_id, 0) + 1
+
+        if not self.histograms:
+            return
+
+        if "country" in relay:
+            country = relay["country"].upper()
+            cw = relay.setdefault("consensus_weight_fraction", 0)
+            for group in ["all"] + groups:
+                relay_count, cw_fraction = self.countries[group]
+                relay_count[country] = relay_count.get(country, 0) + 1
+                cw_fraction[country] = cw_fraction.get(country, 0) + cw
+
+        if not allows_everything_or_nothing(relay["exit_policy_summary"]):
+            for low, high in accepted_intervals(relay["exit_policy_summary"]):
+                self.port_diff[low] += 1
+                self.port_diff[high + 1] -= 1
+
+    def port_histogram(self):
+        """ Number of relays accepting each port, indexed by port number """
+        return prefix_counts(self.port_diff)
@@ -0,0 +1,162 @@
+"""
+    RankingSnapshot stores what a relay_rank.py run needs to know about the previous
+    run in order to work incrementally:
+        - a hash of the family fields of every relay, to find the relays whose family
+          ties changed
+        - each relay's contribution to the network-wide histograms, so that the
+          histograms can be updated by deltas
+        - the families and their contacts, so that only families touched by added,
+          removed or changed relays are regrouped and have their contacts rebuilt
+    Badges are not kept: they hold percentiles over all families and relays, which
+    change whenever a single relay joins or leaves the network.
+    A run without --incremental still writes the snapshot for the next run.
+"""
+
+import os, json, hashlib
+
+from global_vars import *
+from app.controllers.exit_policy import accepted_intervals, allows_everything_or_nothing, MAX_PORT
+
+# Fields that decide which family a relay is in, and the contact kept for the family
+TOPOLOGY_FIELDS = ["effective_family", "indirect_family", "alleged_family", "contact"]
+
+# Fields of a record that make up the relay's contribution to the histograms
+CONTRIBUTION_FIELDS = ["country", "cw", "flags", "ports"]
+
+# Relay subsets with their own country statistics
+COUNTRY_GROUPS = ["all", "Exit", "Guard"]
+
+class RankingSnapshot(object):
+
+    def __init__(self, path=abs_paths["snapshot"]):
+        self.path = path
+        # Whether a previous snapshot was loaded and deltas can be used
+        self.incremental = False
+        # State of the previous run
+        self.records = {}
+        self.families = []
+        self.contacts = {}
+        self.port_histogram = None
+        self.country_counts = {}
+        # State of the current run, filled by diff and by the family aggregator
+        self.new_records = {}
+        self.new_contacts = {}
+        self.added, self.removed, self.changed, self.contributions = [], [], [], []
+        self.touched_relays = set()
+
+    def load(self):
+        """ Loads the previous snapshot. Returns False if there is none """
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, "r") as fp:
+            store = json.load(fp)
+        self.records = store["relays"]
+        self.families = store["families"]
+        self.contacts = store.get("contacts", {})
+        self.port_histogram = store["port_histogram"]
+        self.country_counts = store["country_counts"]
+        self.incremental = True
+        return True
+
+    def save(self, families, port_histogram, country_counts):
+        """ Writes the state of the current run """
+        store = {
+            "relays": self.new_records,
+            "families": [[relay["fingerprint"] for relay in family["families"]] for family in families],
+            "contacts": self.new_contacts,
+            "port_histogram": port_histogram,
+            "country_counts": country_counts
+        }
+        with open(self.path + ".tmp", "w+") as fp:
+            fp.write(json.dumps(store))
+        os.rename(self.path + ".tmp", self.path)
+
+    # Diffing relays
+    def relay_hash(self, relay, fields):
+        return hashlib.md5(json.dumps([relay.get(field) for field in fields], sort_keys=True)).hexdigest()
+
+    def relay_record(self, relay):
+        """ The relay's topology hash and its contribution to the histograms """
+        ports = None
+        if "exit_policy_summary" in relay and not allows_everything_or_nothing(relay["exit_policy_summary"]):
+            ports = accepted_intervals(relay["exit_policy_summary"])
+        return {
+            "topology": self.relay_hash(relay, TOPOLOGY_FIELDS),
+            "country": relay["country"].upper() if "country" in relay else None,
+            "cw": relay.get("consensus_weight_fraction", 0),
+            "flags": [flag for flag in ["Exit", "Guard"] if relay.has_flag(flag)],
+            "ports": ports
+        }
+
+    def diff(self, relays):
+        """
+            Compares the relays with the previous snapshot by fingerprint. A relay
+            counts as changed when its topology hash changed; bandwidth and other
+            hourly values do not affect the families
+        """
+        self.new_records = dict((relay["fingerprint"], self.relay_record(relay)) for relay in relays)
+        self.added = [fingerprint for fingerprint in self.new_records if fingerprint not in self.records]
+        self.removed = [fingerprint for fingerprint in self.records if fingerprint not in self.new_records]
+        self.changed = [fingerprint for fingerprint, record in self.new_records.items()
+                        if fingerprint in self.records and self.records[fingerprint].get("topology") != record["topology"]]
+        # Relays whose contribution to the histograms changed, e.g. their consensus weight
+        self.contributions = [fingerprint for fingerprint, record in self.new_records.items()
+                              if fingerprint in self.records and self.contribution(self.records[fingerprint]) != self.contribution(record)]
+        self.touched_relays = set(self.added + self.removed + self.changed)
+        print "[RankingSnapshot] %d added, %d removed, %d changed relays" % (len(self.added), len(self.removed), len(self.changed))
+
+    def touched(self):
+        return self.touched_relays
+
+    def contribution(self, record):
+        return [record.get(field) for field in CONTRIBUTION_FIELDS]
+
+    def deltas(self):
+        """ Yields (record, sign) for every contribution to take out of or add to the histograms """
+        for fingerprint in self.removed + self.contributions:
+            yield (self.records[fingerprint], -1)
+        for fingerprint in self.added + self.contributions:
+            yield (self.new_records[fingerprint], 1)
+
+    # Histograms
+    def update_port_histogram(self):
+        """ Applies the deltas to the previous port histogram """
+        diff = [0] * (MAX_PORT + 2)
+        for record, sign in self.deltas():
+            for low, high in record["ports"] or []:
+                diff[low] += sign
+                diff[high + 1] -= sign
+
+        histogram = list(self.port_histogram)
+        count = 0
+        for port in range(1, MAX_PORT + 1):
+            count += diff[port]
+            histogram[port] += count
+        return histogram
+
+    def update_country_counts(self, group):
+        """
+            Applies the deltas to the previous country counts of a relay group ("all",
+            "Exit" or "Guard"). Returns (relay_count, cw_fraction) dicts
+        """
+        relay_count = dict(self.country_counts[group]["relay_count"])
+        cw_fraction = dict(self.country_counts[group]["cw_fraction"])
+        for record, sign in self.deltas():
+            if record["country"] is None or (group != "all" and group not in record["flags"]):
+                continue
+            relay_count[record["country"]] = relay_count.get(record["country"], 0) + sign
+            cw_fraction[record["country"]] = cw_fraction.get(record["country"], 0) + sign * record["cw"]
+        return (relay_count, cw_fraction)
+
+    # Families
+    def cached_contacts(self, members):
+        """
+            The (contacts, bitcoin address) of the family with these member
+            fingerprints, in order, from the previous run. None if it was touched
+        """
+        if not self.incremental or any(fingerprint in self.touched_relays for fingerprint in members):
+            return None
+        return self.contacts.get(",".join(members))
+
+    def store_contacts(self, members, contacts, bitcoin_addr):
+        self.new_contacts[",".join(members)] = [contacts, bitcoin_addr]
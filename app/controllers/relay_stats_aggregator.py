@@ -6,12 +6,20 @@
 
 # Imports
 from app import app
-import os, json, re
+import os, json, re, multiprocessing
 from global_vars import *
+from app.controllers.exit_policy import accepted_intervals, allows_everything_or_nothing, count_in_intervals, rare_port_prefix
 
 ### Global vars ###
 coefficient_file = "app/static/json/rank_coefficients.json"
 
+# Aggregator shared with the badge workers, which inherit it when the pool forks
+pool_aggregator = None
+
+def analyze_families_in_worker(args):
+    indexes, curr_time = args
+    return [pool_aggregator.analyze_family(pool_aggregator.families[i], curr_time) for i in indexes]
+
 class RelayStatsAggregator(object):
 
     def __init__(self, grouped_relays):
@@ -31,19 +39,54 @@ class RelayStatsAggregator(object):
         self.country_guard_rankings = grouped_relays["country_guard_rankings"]
         self.country_guard_ordered_by_relay_count = grouped_relays["country_guard_ordered_by_relay_count"]
         self.port_rankings = grouped_relays["port_rankings"]
+        # Ports accepted by at most 500 relays count towards the liberal exit badge
+        self.rare_ports = rare_port_prefix(self.port_rankings, 500)
+        self.as_orgs = grouped_relays["as_orgs"]
         self.org_exit_histogram = grouped_relays["org_exit_histogram"]
         self.org_exit_ordered = grouped_relays["org_exit_ordered"]
         self.org_guard_histogram = grouped_relays["org_guard_histogram"]
         self.org_guard_ordered = grouped_relays["org_guard_ordered"]
 
-    def find_by_fingerprint(self, fingerprint, families):
+        # Rarity percentile of each country and org_id among the Guard and Exit relays,
+        # i.e. its position in the histogram ordered by relay count. These tables are
+        # built once and only read by the diversity badges
+        self.country_percentiles = {
+            "Guard": self.percentile_table(self.country_guard_ordered_by_relay_count),
+            "Exit": self.percentile_table(self.country_exit_ordered_by_relay_count)
+        }
+        self.org_percentiles = {
+            "Guard": self.percentile_table(self.org_guard_ordered),
+            "Exit": self.percentile_table(self.org_exit_ordered)
+        }
+
+        # fingerprint => (family, rank position) for each ranking list, keyed by id of the list
+        self.rank_indexes = {}
+        for rankings in [self.families, self.bandwidth_rankings, self.consensus_weight_rankings,
+                         self.exit_bandwidth_rankings, self.age_rank, self.uptime_rank]:
+            self.rank_indexes[id(rankings)] = self.index_rankings(rankings)
+
+    def percentile_table(self, ordered_histogram):
+        """ Maps each key of a histogram ordered by count to its position / number of keys """
+        table = {}
+        for position, (key, count) in enumerate(ordered_histogram):
+            table.setdefault(key, float(position) / len(ordered_histogram))
+        return table
+
+    def index_rankings(self, families):
+        index = {}
         counter = 1
         for family in families:
             for relay in family["families"]:
-                if relay["fingerprint"] == fingerprint:
-                    return (family, counter)
+                if relay["fingerprint"] not in index:
+                    index[relay["fingerprint"]] = (family, counter)
             counter += 1
-        return ""
+        return index
+
+    def find_by_fingerprint(self, fingerprint, families):
+        index = self.rank_indexes.get(id(families))
+        if index is None:
+            index = self.index_rankings(families)
+        return index.get(fingerprint, "")
 
     def get_badge(self, counter, denom):
         percentile = float(denom - counter) / float(denom)
@@ -113,7 +156,7 @@ class RelayStatsAggregator(object):
     def get_guard_badge(self, fingerprint):
         family, counter = self.find_by_fingerprint(fingerprint, self.families)
         numRelays = len(family["families"])
-        numGuard = sum([1 for relay in family["families"] if "Guard" in relay["flags"]])
+        numGuard = sum([1 for relay in family["families"] if relay.has_flag("Guard")])
         return float(numGuard)/float(numRelays) >= 0.5
 
     def has_geo_diversity(self, fingerprint):
@@ -133,45 +176,16 @@ class RelayStatsAggregator(object):
                     rare_countries.append(relay["country"].upper())
         return (lone_relay_in_country, rare_countries)
 
-    # Helper function for get_liberal_exit_badge
-    def parse_between(self, string):
-        if "-" in string:
-            res = string.split("-")
-            return [int(res[0]), int(res[1])]
-        return [int(string)]
-
     def get_liberal_exit_badge(self, fingerprint):
         family, counter = self.find_by_fingerprint(fingerprint, self.families)
-        liberal_exits = []
-        init_vals = {"accept": 1, "reject": 0}
+        totalLiberal = 0
 
         for relay in family["families"]:
-            policy = relay["exit_policy_summary"].keys()[0]
-            if relay["exit_policy_summary"][policy][0] == "1-65535":
+            if allows_everything_or_nothing(relay["exit_policy_summary"]):
                 continue
+            # Count the rare ports that the relay accepts
+            totalLiberal += count_in_intervals(accepted_intervals(relay["exit_policy_summary"]), self.rare_ports)
 
-            ports, offset_value = relay["exit_policy_summary"][policy], init_vals[policy]
-            opposite_offset = (offset_value + (-1)) % 2
-
-            # Initialization
-            relay_ports = {}
-            for i in range(1, 65536):
-                relay_ports[i] = opposite_offset
-
-            for interval in ports:
-                parsed = self.parse_between(interval)
-                if len(parsed) == 1:
-                    relay_ports[parsed[0]] = offset_value
-                else:
-                    for i in range(parsed[0], parsed[1]+1):
-                        relay_ports[i] = offset_value
-
-            # See if each port that the relay allows is a rare port
-            for port in relay_ports.keys():
-                if self.port_rankings[port] <= 500:
-                    liberal_exits.append(port)
-
-        totalLiberal = len(liberal_exits)
         if totalLiberal >= 50:
             return (totalLiberal, "platinum")
         elif totalLiberal >= 30:
@@ -187,7 +201,7 @@ class RelayStatsAggregator(object):
     def get_tor_version_badge(self, fingerprint):
         family, counter = self.find_by_fingerprint(fingerprint, self.families)
         for relay in family["families"]:
-            if not relay.setdefault("runs_recommended_tor", False):
+            if not relay.get("runs_recommended_tor", False):
                 return False
         return True
 
@@ -195,54 +209,17 @@ class RelayStatsAggregator(object):
         # print "[get_country_diversity_badge] Called"
         family, c = self.find_by_fingerprint(fingerprint, self.families)
 
-        rankings = {}
-        countries_ordered_by_relay_count = []
-
-        if flag == "Guard":
-            # Will be using relay_count => can switch to cw_fraction if necessary
-            rankings = self.country_guard_rankings["relay_count"]
-            countries_ordered_by_relay_count = self.country_guard_ordered_by_relay_count
-        else:
-            rankings = self.country_exit_rankings["relay_count"]
-            countries_ordered_by_relay_count = self.country_exit_ordered_by_relay_count
-
-        # This excludes any country without any relay
-        # countries_ordered_by_relay_count = sorted([ (country, count) for country, count in rankings.items() if count != 0 ], key=lambda item: item[1])
-
-        num_countries = len(countries_ordered_by_relay_count)
+        # Will be using relay_count => can switch to cw_fraction if necessary
+        percentiles = self.country_percentiles[flag]
         smallest_percentile = 1.0
 
         for relay in family["families"]:
             # We only care about relays with either the Guard or Exit flag
-            if flag in relay["flags"]:
-                counter = 0
-                for country, count in countries_ordered_by_relay_count:
-                    if "country" in relay and relay["country"].upper() == country:
-                        # print "[get_country_diversity_badge] Hit with counter: %d" % counter
-                        break
-                    else:
-                        counter += 1
-                percentile = float(counter) / float(num_countries)
-                # print percentile
-                if percentile < smallest_percentile:
-                    smallest_percentile = percentile
-            else:
-                continue
+            if relay.has_flag(flag) and "country" in relay:
+                # Countries missing from the histogram count as the most common
+                smallest_percentile = min(smallest_percentile, percentiles.get(relay["country"].upper(), 1.0))
 
-        # print smallest_percentile
-
-        # print "[get_country_diversity_badge] Percentage is %.2f" % (1.0 - float(smallest_percentile))
-
-        if smallest_percentile > 0.8:
-            return (1.0 - smallest_percentile, "None")
-        elif smallest_percentile > 0.6:
-            return (1.0 - smallest_percentile, "bronze")
-        elif smallest_percentile > 0.4:
-            return (1.0 - smallest_percentile, "silver")
-        elif smallest_percentile > 0.2:
-            return (1.0 - smallest_percentile, "gold")
-        else:
-            return (1.0 - smallest_percentile, "platinum")
+        return self.diversity_badge(smallest_percentile)
 
     def get_org_id_diversity_badge(self, fingerprint, flag):
         """
@@ -251,34 +228,18 @@ class RelayStatsAggregator(object):
         """
         family, counter = self.find_by_fingerprint(fingerprint, self.families)
 
-        histogram = {}
-
-        if flag == "Guard":
-            histogram = self.org_guard_histogram
-            histogram["ordered_histogram"] = self.org_guard_ordered
-        else:
-            histogram = self.org_exit_histogram
-            histogram["ordered_histogram"] = self.org_exit_ordered
-
-        # Very bad time performance
-        # histogram["ordered_histogram"] = sorted( [(org_id, count) for org_id, count in histogram["org_2_hist"].items() if count != 0], key=lambda item: item[1])
-
-        num_org_ids = len(histogram["ordered_histogram"])
+        percentiles = self.org_percentiles[flag]
         smallest_percentile = 1.0
 
         for relay in family["families"]:
-            if flag in relay["flags"] and "as_number" in relay:
-                relay_org_id = histogram["as_2_org"][relay["as_number"][2:]][0]
-                counter = 0
-                for org_id, count in histogram["ordered_histogram"]:
-                    if relay_org_id == org_id:
-                        break
-                    else:
-                        counter += 1
-                percentile = float(counter) / float(num_org_ids)
-                if percentile < smallest_percentile:
-                    smallest_percentile = percentile
+            if relay.has_flag(flag) and "as_number" in relay:
+                relay_org_id = self.as_orgs.org_id(relay["as_number"])
+                smallest_percentile = min(smallest_percentile, percentiles.get(relay_org_id, 1.0))
+
+        return self.diversity_badge(smallest_percentile)
 
+    def diversity_badge(self, smallest_percentile):
+        """ Badge for the rarest country or org_id of a family, given its percentile """
         if smallest_percentile > 0.8:
             return (1.0 - smallest_percentile, "None")
         elif smallest_percentile > 0.6:
@@ -307,7 +268,7 @@ class RelayStatsAggregator(object):
         family, counter = self.find_by_fingerprint(fingerprint, self.families)
 
         for relay in family["families"]:
-            if for_exit and "Exit" not in relay["flags"]:
+            if for_exit and not relay.has_flag("Exit"):
                 continue
             else:
                 if "or_addresses" in relay:
@@ -387,3 +348,30 @@ class RelayStatsAggregator(object):
         badges["has_ipv6_for_exit"] = self.get_ipv6_badge(fingerprint, True)
         badges["overall_rank"] = self.get_overall_rank(badges)
         return badges
+
+    def analyze_families(self, indexes, curr_time, processes=1):
+        """
+            Batch version of analyze_family. Returns the badges of the families at the
+            given indexes of self.families, in order. With processes > 1 the families
+            are split across a process pool, whose workers inherit this aggregator
+            and its rankings when the pool forks instead of receiving copies
+        """
+        global pool_aggregator
+
+        if processes <= 1 or len(indexes) < processes:
+            return [self.analyze_family(self.families[i], curr_time) for i in indexes]
+
+        # Several chunks per worker, as families differ a lot in size
+        size = max(1, len(indexes) / (processes * 4))
+        chunks = [(indexes[i:i + size], curr_time) for i in range(0, len(indexes), size)]
+
+        pool_aggregator = self
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(analyze_families_in_worker, chunks)
+        finally:
+            pool.close()
+            pool.join()
+            pool_aggregator = None
+
+        return [badges for result in results for badges in result]
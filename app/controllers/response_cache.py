@@ -0,0 +1,88 @@
+"""
+    ResponseCache memoizes rendered responses of the Flask views.
+    Entries are keyed by path and query string and are only valid for the ranking
+    snapshot they were rendered from, since the data only changes once per
+    relay_rank.py run. Pages that do not depend on the rankings use a cache with a
+    constant version. Cached responses carry an ETag per encoding and the
+    Last-Modified time of the data, answer conditional requests with 304, and are
+    served gzip-compressed to clients that accept it, compressing each body once.
+"""
+
+import gzip, hashlib, functools, threading
+from collections import OrderedDict
+from StringIO import StringIO
+
+from flask import request, make_response, Response
+
+def compress(body):
+    buf = StringIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=9) as fp:
+        fp.write(body)
+    return buf.getvalue()
+
+class CachedResponse(object):
+
+    def __init__(self, version, response, last_modified=None):
+        self.version = version
+        self.body = response.get_data()
+        self.gzipped = compress(self.body)
+        self.mimetype = response.mimetype
+        self.etag = hashlib.md5(self.body).hexdigest()
+        self.last_modified = last_modified
+
+    def respond(self):
+        # The encodings are different representations, so each gets its own ETag
+        if "gzip" in request.headers.get("Accept-Encoding", ""):
+            response = Response(self.gzipped, mimetype=self.mimetype)
+            response.headers["Content-Encoding"] = "gzip"
+            response.set_etag(self.etag + "-gzip")
+        else:
+            response = Response(self.body, mimetype=self.mimetype)
+            response.set_etag(self.etag)
+        response.headers["Vary"] = "Accept-Encoding"
+        if self.last_modified is not None:
+            response.last_modified = self.last_modified
+        return response.make_conditional(request)
+
+class ResponseCache(object):
+
+    def __init__(self, version, last_modified=None, max_entries=1024):
+        """
+            version is a function returning the current ranking snapshot version, and
+            last_modified an optional function returning the time that snapshot was
+            written, as a datetime. At most max_entries responses are kept, least
+            recently used first out
+        """
+        self.version = version
+        self.last_modified = last_modified
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def cached(self, view):
+        """ Decorator for views whose output only depends on the ranking snapshot """
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != "GET":
+                return view(*args, **kwargs)
+
+            version = self.version()
+            key = (request.path, request.query_string)
+            with self.lock:
+                entry = self.entries.pop(key, None)
+                if entry is not None and entry.version == version:
+                    self.entries[key] = entry
+                    return entry.respond()
+
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+
+            last_modified = self.last_modified() if self.last_modified is not None else None
+            entry = CachedResponse(version, response, last_modified)
+            with self.lock:
+                self.entries[key] = entry
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+            return entry.respond()
+        return wrapper
@@ -3,9 +3,12 @@ import urllib
 import urllib2
 import json
 import threading
-import _strptime
-from datetime import timedelta, datetime
+import time
+import itertools
+import multiprocessing
+import numpy
 from app.models.onionoo_connector import OnionooConnector
+from app.models.relay import Relay, parse_time
 
 TWO_MONTHS = 2 * 30 * 86400
 
@@ -28,6 +31,20 @@ def return_debug_info(fingerprint, first_seen_check, exit_port_check, uptime_per
     return False
 
 
+def as_epoch(timestamp):
+    """ Accepts epoch seconds, or an Onionoo timestamp string from a document that was not normalized """
+    if isinstance(timestamp, basestring):
+        return parse_time(timestamp)
+    return timestamp
+
+
+def get_first_seen(response):
+    """ first_seen of a Relay or of a plain Onionoo details dict, in epoch seconds """
+    if isinstance(response, Relay):
+        return response.first_seen
+    return as_epoch(response['first_seen'])
+
+
 def fetch_data(doc_type, params):
     """ Fetches onionoo data and returns response formatted as a dictionary """
 
@@ -67,12 +84,11 @@ def calculate_2mo_avg(response, response_type):
     # Sum up all values within past 2 months
     _sum = 0
     count = 0
-    today = datetime.now()
-    first = datetime.strptime(data['first'], "%Y-%m-%d %H:%M:%S")
-    last = datetime.strptime(data['last'], "%Y-%m-%d %H:%M:%S")
+    cutoff = time.time() - TWO_MONTHS
+    first = as_epoch(data['first'])
+    interval = float(data['interval'])
     for i in range(data['count']):
-        value_date = first + timedelta(seconds=(i * float(data['interval'])))
-        if (today - value_date).total_seconds() <= TWO_MONTHS:
+        if first + i * interval >= cutoff:
             if data['values'][i] not in [None, 'null']:
                 _sum += (data['values'][i])
                 count += 1
@@ -97,9 +113,7 @@ def check_in_ports(ports):
 def check_first_seen(response):
     """ Checks if relay was first seen at least 2 months ago """
 
-    today = datetime.now()
-    first_seen = datetime.strptime(response['first_seen'], "%Y-%m-%d %H:%M:%S")
-    return (today - first_seen).total_seconds() >= TWO_MONTHS
+    return time.time() - get_first_seen(response) >= TWO_MONTHS
 
 
 def check_exit_port(response):
@@ -147,11 +161,9 @@ def check_tshirt(fingerprint, connector):
         exit()
     """
 
-    details_data = connector.find_by_fingerprint(connector.details_relays, fingerprint)
-    uptime_data = connector.find_by_fingerprint(connector.uptime_relays, fingerprint)
-    bandwidth_data = connector.find_by_fingerprint(connector.bandwidth_relays, fingerprint)
+    details_data, uptime_data, bandwidth_data = connector.find_documents(fingerprint)
 
-    if len(details_data) == 0 or len(uptime_data) == 0 or len(bandwidth_data) == 0:
+    if not details_data or not uptime_data or not bandwidth_data:
         return False
 
     first_seen_check = check_first_seen(details_data)
@@ -169,3 +181,108 @@ def check_tshirt(fingerprint, connector):
         uptime_percent = get_uptime_percent(uptime_data[i])
         avg_bandwidth = get_avg_bandwidth(bandwidth_data[i])
     """
+
+
+def get_3_month_history(response, response_type):
+    """ Returns the 3_months history object used by calculate_2mo_avg, or None """
+    if response is None:
+        return None
+    if response_type == 'uptime':
+        return response.get('uptime', {}).get('3_months')
+    return response.get('write_history', {}).get('3_months')
+
+
+def windowed_averages(histories, now):
+    """ Vectorized calculate_2mo_avg over a list of history objects (or None).
+      Returns an array with -1 for missing histories, 0 for histories without
+      values in the past 2 months, and the scaled average otherwise """
+
+    averages = numpy.empty(len(histories))
+    averages.fill(-1.0)
+    present = [i for i, data in enumerate(histories) if data is not None]
+    if len(present) == 0:
+        return averages
+
+    data = [histories[i] for i in present]
+    lengths = numpy.array([min(d['count'], len(d['values'])) for d in data], dtype=numpy.int64)
+    first = numpy.array([as_epoch(d['first']) for d in data], dtype=float)
+    interval = numpy.array([d['interval'] for d in data], dtype=float)
+    factor = numpy.array([d['factor'] for d in data], dtype=float)
+
+    # Index of the first value within the past 2 months of each series
+    cutoff_index = numpy.maximum(numpy.ceil((now - TWO_MONTHS - first) / interval), 0)
+
+    # All values in one flat array, null values become nan
+    values = numpy.array(list(itertools.chain.from_iterable(d['values'][:n] for d, n in zip(data, lengths))), dtype=float)
+    series = numpy.repeat(numpy.arange(len(data)), lengths)
+    offsets = numpy.concatenate(([0], numpy.cumsum(lengths)[:-1]))
+    position = numpy.arange(len(values)) - numpy.repeat(offsets, lengths)
+
+    in_window = (position >= numpy.repeat(cutoff_index, lengths)) & ~numpy.isnan(values)
+    sums = numpy.bincount(series, weights=numpy.where(in_window, values, 0), minlength=len(data))
+    counts = numpy.bincount(series, weights=in_window, minlength=len(data))
+
+    averages[present] = numpy.where(counts > 0, sums * factor / numpy.maximum(counts, 1), 0)
+    return averages
+
+
+def evaluate_tshirts(connector, fingerprints):
+    """ Evaluates the t-shirt qualification criteria for the given fingerprints
+      and returns a dict of fingerprint => eligibility """
+
+    now = time.time()
+    documents = [connector.find_documents(fingerprint) for fingerprint in fingerprints]
+
+    uptime = windowed_averages([get_3_month_history(uptime_data, 'uptime') for details_data, uptime_data, bandwidth_data in documents], now)
+    bandwidth = windowed_averages([get_3_month_history(bandwidth_data, 'bandwidth') for details_data, uptime_data, bandwidth_data in documents], now)
+    uptime_percent = numpy.round(uptime * 100, 2)
+    avg_bandwidth = numpy.round(bandwidth / 1000.0, 2)
+
+    eligible = {}
+    for i, (fingerprint, (details_data, uptime_data, bandwidth_data)) in enumerate(zip(fingerprints, documents)):
+        if not details_data or not uptime_data or not bandwidth_data:
+            eligible[fingerprint] = False
+            continue
+        first_seen_check = now - get_first_seen(details_data) >= TWO_MONTHS
+        exit_port_check = check_exit_port(details_data)
+        eligible[fingerprint] = return_debug_info(fingerprint, first_seen_check, exit_port_check,
+                                                  uptime_percent[i], avg_bandwidth[i])
+    return eligible
+
+
+# Connector shared with the worker processes of check_tshirts. Workers are
+# forked after it is set, so they inherit it instead of receiving a copy
+pool_connector = None
+
+def evaluate_tshirts_in_worker(fingerprints):
+    return evaluate_tshirts(pool_connector, fingerprints)
+
+
+def check_tshirts(connector, processes=1):
+    """ Batch version of check_tshirt. Evaluates the t-shirt qualification criteria
+      for every relay of the connector's details document once and returns a dict
+      of fingerprint => eligibility. With processes > 1 the relays are split
+      across a process pool """
+
+    global pool_connector
+
+    fingerprints = [relay['fingerprint'] for relay in connector.details_relays]
+    if processes <= 1 or len(fingerprints) < processes:
+        return evaluate_tshirts(connector, fingerprints)
+
+    size = (len(fingerprints) + processes - 1) / processes
+    chunks = [fingerprints[i:i + size] for i in range(0, len(fingerprints), size)]
+
+    pool_connector = connector
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(evaluate_tshirts_in_worker, chunks)
+    finally:
+        pool.close()
+        pool.join()
+        pool_connector = None
+
+    eligible = {}
+    for result in results:
+        eligible.update(result)
+    return eligible
@@ -1,72 +1,54 @@
 import re, uuid, time, datetime
 from global_vars import *
-import json
+from app.models.uuid_store import UUIDStore
 
-def add_uuid(flag, data_store):
+def add_uuid(families):
     """
-    Function that adds uuid to every relay. The uuids are taken
-    from static/json/fingerprint_to_uuid.json and static/json/uuid_to_family.json. The uuids
+    Function that tags every relay with the uuid of its family. The uuids are taken
+    from the UUIDStore in static/json/uuid_store.db. The uuids
     help keep persistent data about each family by tagging every relay within the family
 
+    Every family gets one uuid: the oldest uuid among its members, or a new one if
+    none of them was tagged before. Members with a different uuid are retagged, so
+    a family keeps its uuid across runs even when members join it
+
     Args:
-        flag (str)          :  Indicates type of data_store ("relays" or "families")
-        data_store (list)   :  List of objects. Should correspond to flag. So if flag is "relays",
-                               data_store should be a list of relays
+        families (list)     :  List of families, as built by FamilyAggregator
     """
+    store = UUIDStore()
+    fingerprint_to_uuid = store.get_uuids(relay["fingerprint"] for family in families for relay in family["families"])
+    created = store.get_created(set(fingerprint_to_uuid.values()))
+
+    ### Larger families pick first, so when a family splits the bigger part keeps the uuid
+    order = sorted(families, key=lambda family: (-len(family["families"]), min(relay["fingerprint"] for relay in family["families"])))
+
+    uuid_to_family = {}
+    minted = []
+    retagged = {}
+    for family in order:
+        members = family["families"]
+        ### uuids minted before their times were recorded count as the oldest
+        candidates = sorted(set(fingerprint_to_uuid[relay["fingerprint"]] for relay in members if relay["fingerprint"] in fingerprint_to_uuid),
+                            key=lambda candidate: (created.get(candidate, 0), candidate))
+        candidates = [candidate for candidate in candidates if candidate not in uuid_to_family]
+        if candidates:
+            fam_uuid = candidates[0]
+        else:
+            fam_uuid = str(uuid.uuid4())
+            minted.append(fam_uuid)
 
-    ### Load the json files from db_abs_paths
-    f = open(db_abs_paths["fingerprint_to_uuid"], "r+")
-    fingerprint_to_uuid = json.load(f)
-    f.close()
+        for relay in members:
+            relay["uuid"] = fam_uuid
+            if fingerprint_to_uuid.get(relay["fingerprint"]) != fam_uuid:
+                retagged[relay["fingerprint"]] = fam_uuid
+        uuid_to_family[fam_uuid] = [relay["fingerprint"] for relay in members]
 
-    f = open(db_abs_paths["uuid_to_family"], "r+")
-    uuid_to_family = json.load(f)
-    f.close()
+    ### uuids that no family kept lose their members
+    for old_uuid in set(fingerprint_to_uuid.values()):
+        uuid_to_family.setdefault(old_uuid, [])
 
-    ### Now loop through stores
-    if flag == "relays":
-        for relay in data_store:
-            if relay["fingerprint"] in fingerprint_to_uuid:
-                ### We've seen this relay before
-                relay["uuid"] = fingerprint_to_uuid[relay["fingerprint"]]
-            else:
-                ### New relay, see if any family members have a uuid
-                ### Create extended_family field
-                if "extended_family" not in relay:
-                    relay["extended_family"] = relay.setdefault("effective_family",[]) + relay.setdefault("indirect_family", [])
-                for fingerprint in relay["extended_family"]:
-                    ### make sure to take out initial $ sign
-                    if fingerprint[1:] in fingerprint_to_uuid:
-                        relay["uuid"] = fingerprint_to_uuid[fingerprint[1:]]
-                        ### Update the store
-                        fingerprint_to_uuid[relay["fingerprint"]] = relay["uuid"]
-                ### At this point, if relay has no uuid field, then its family members also did not uuids.
-                ### Hence we create a new uuid
-                new_uuid = str(uuid.uuid4())
-                relay["uuid"] = new_uuid
-                ### Update the store
-                fingerprint_to_uuid[relay["fingerprint"]] = relay["uuid"]
-        ### Now we update the store on disk
-        f = open(db_abs_paths["fingerprint_to_uuid"], "w+")
-        f.write(json.dumps(fingerprint_to_uuid))
-        f.close()
-        return data_store
-    else:
-        ### flag is families
-        ### Since add_uuid should be called for relays first, we just pull each uuid from
-        ### fingerprint_to_uuid.json. Then we add new families to uuid_to_family.json
-        for family in data_store:
-            for relay in family["families"]:
-                try:
-                    relay["uuid"] = fingerprint_to_uuid[relay["fingerprint"]]
-                except:
-                    print "[add_uuid] Relay not tagged in fingerprint_to_uuid.json"
-            ### Now see if fingerprint is found in uuid_to_family. If not, then create a new entry
-            fam_uuid = family["families"][0]["uuid"]
-            ### Update to latest family data
-            uuid_to_family[fam_uuid] = family
-        ### Now update the store
-        f = open(db_abs_paths["uuid_to_family"], "w+")
-        f.write(json.dumps(uuid_to_family))
-        f.close()
-        return data_store
+    ### Now write everything to the store in one transaction
+    print "[add_uuid] %d new uuids, %d relays retagged" % (len(minted), len(retagged))
+    store.commit_tagging(minted, int(time.time()), retagged, uuid_to_family)
+    store.close()
+    return families
@@ -0,0 +1,76 @@
+"""
+    AsOrgLookup maps AS numbers to the AS organizations of as2orgname.json, a
+    CAIDA-derived mapping of AS number => (org_id, org name). The mapping is loaded
+    once per process and kept compact: the AS numbers are a sorted array of
+    integers, with a parallel array of indexes into the list of distinct org ids,
+    so every org id is stored once and a lookup is a binary search.
+    The table is never modified. AS numbers it does not know map to
+    "Unknown/AS<number>".
+"""
+
+import json, bisect
+from array import array
+
+class AsOrgLookup(object):
+
+    # path => AsOrgLookup, so the mapping is only loaded once per process
+    loaded = {}
+
+    @classmethod
+    def load(cls, path="as2orgname.json"):
+        if path not in cls.loaded:
+            print "[AsOrgLookup] Loading %s" % path
+            with open(path, "r") as fp:
+                cls.loaded[path] = cls(json.load(fp))
+        return cls.loaded[path]
+
+    def __init__(self, as2org):
+        """ as2org maps AS numbers (as strings) to (org_id, org name) """
+        # Distinct org ids and their names, and the index of each org id
+        self.org_ids = []
+        self.org_names = []
+        org_index = {}
+
+        entries = []
+        for as_number, org in as2org.items():
+            org_id = org[0]
+            if org_id not in org_index:
+                org_index[org_id] = len(self.org_ids)
+                self.org_ids.append(org_id)
+                self.org_names.append(org[1] if len(org) > 1 else org_id)
+            entries.append((int(as_number), org_index[org_id]))
+        entries.sort()
+
+        self.as_numbers = array("I", [as_number for as_number, i in entries])
+        self.orgs = array("I", [i for as_number, i in entries])
+
+    def parse(self, as_number):
+        """ Accepts "AS1234", "1234" or 1234 """
+        if isinstance(as_number, basestring) and as_number.upper().startswith("AS"):
+            as_number = as_number[2:]
+        return int(as_number)
+
+    def find(self, as_number):
+        """ Index of the AS number's org id, or None if it is unknown """
+        try:
+            as_number = self.parse(as_number)
+        except ValueError:
+            return None
+        i = bisect.bisect_left(self.as_numbers, as_number)
+        if i < len(self.as_numbers) and self.as_numbers[i] == as_number:
+            return self.orgs[i]
+        return None
+
+    def org_id(self, as_number):
+        i = self.find(as_number)
+        if i is None:
+            if isinstance(as_number, basestring) and as_number.upper().startswith("AS"):
+                as_number = as_number[2:]
+            return "Unknown/AS" + str(as_number)
+        return self.org_ids[i]
+
+    def org_name(self, as_number):
+        i = self.find(as_number)
+        if i is None:
+            return self.org_id(as_number)
+        return self.org_names[i]
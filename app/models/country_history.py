@@ -0,0 +1,108 @@
+"""
+    CountryHistory is a time series store for the relay count and consensus weight
+    fraction of every country, recorded once per relay_rank.py run. Each series is
+    a column of fixed-width binary records in its own file:
+        timestamps.bin      time of each run, int64 epoch seconds
+        <CC>.bin            (relay_count, cw_fraction) float64 pairs, one per run
+    Appending a run adds one record to the end of each file. A query for a country
+    binary searches the timestamps for the time range and then only reads that
+    range of records from the country's file, locally or with a ranged S3 GET.
+    The timestamps file is written last, so its length is the number of complete
+    runs; records past it, left behind by an interrupted run, are overwritten.
+"""
+
+import os
+
+import boto
+import boto.exception
+import numpy
+
+from global_vars import *
+
+TIMESTAMP = numpy.dtype("<i8")
+RECORD = numpy.dtype([("relay_count", "<f8"), ("cw_fraction", "<f8")])
+
+class CountryHistory(object):
+
+    def __init__(self, path=abs_paths["country_history"], strategy="LOCAL"):
+        """ Under the REMOTE strategy the series are read from S3 under country_history/ """
+        self.path = path
+        self.strategy = strategy
+        self.bucket = None
+
+    def get_bucket(self):
+        """ Reuses a single S3 connection for all requests """
+        if self.bucket is None:
+            c = boto.connect_s3(acc_key, acc_sec)
+            self.bucket = c.get_bucket(bucket)
+        return self.bucket
+
+    def read(self, name, offset=0, size=None):
+        """ Reads size bytes (or the rest) of a series file. Returns None if it does not exist """
+        if self.strategy == "LOCAL":
+            path = os.path.join(self.path, name)
+            if not os.path.exists(path):
+                return None
+            with open(path, "rb") as fp:
+                fp.seek(offset)
+                return fp.read() if size is None else fp.read(size)
+        key = self.get_bucket().get_key("country_history/" + name)
+        if key is None:
+            return None
+        if size == 0:
+            return ""
+        end = "" if size is None else str(offset + size - 1)
+        try:
+            return key.get_contents_as_string(headers={"Range": "bytes=%d-%s" % (offset, end)})
+        except boto.exception.S3ResponseError as e:
+            # The range starts past the end of a short series
+            if e.status == 416:
+                return ""
+            raise
+
+    def timestamps(self):
+        data = self.read("timestamps.bin")
+        if data is None:
+            return numpy.zeros(0, TIMESTAMP)
+        # Ignore a partially written timestamp
+        return numpy.frombuffer(data[:len(data) - len(data) % TIMESTAMP.itemsize], TIMESTAMP)
+
+    def append(self, timestamp, relay_count, cw_fraction):
+        """
+            Records one run. relay_count and cw_fraction map country codes to values.
+            Countries without an earlier record get zeros for the runs before
+        """
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        timestamps_path = os.path.join(self.path, "timestamps.bin")
+        # Complete runs, from the file size alone
+        runs = os.path.getsize(timestamps_path) // TIMESTAMP.itemsize if os.path.exists(timestamps_path) else 0
+
+        for country in set(relay_count) | set(cw_fraction):
+            record = numpy.array([(relay_count.get(country, 0), cw_fraction.get(country, 0))], RECORD)
+            with open(os.path.join(self.path, country.upper() + ".bin"), "ab") as fp:
+                # Pads new series with zeros and drops records of an interrupted run
+                fp.truncate(runs * RECORD.itemsize)
+                fp.write(record.tobytes())
+
+        with open(timestamps_path, "ab") as fp:
+            fp.truncate(runs * TIMESTAMP.itemsize)
+            fp.write(numpy.array([timestamp], TIMESTAMP).tobytes())
+
+    def query(self, country, start=None, end=None):
+        """
+            Returns the records of a country between start and end (epoch seconds,
+            inclusive) as a list of (timestamp, relay_count, cw_fraction), or None if
+            the country has no series
+        """
+        timestamps = self.timestamps()
+        first = 0 if start is None else numpy.searchsorted(timestamps, start, "left")
+        last = len(timestamps) if end is None else numpy.searchsorted(timestamps, end, "right")
+
+        data = self.read(country.upper() + ".bin", first * RECORD.itemsize, max(last - first, 0) * RECORD.itemsize)
+        if data is None:
+            return None
+        # A series that stopped being recorded is shorter than the timestamps
+        records = numpy.frombuffer(data[:len(data) - len(data) % RECORD.itemsize], RECORD)
+        return [(int(timestamp), int(record["relay_count"]), float(record["cw_fraction"]))
+                for timestamp, record in zip(timestamps[first:first + len(records)], records)]
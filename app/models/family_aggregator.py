@@ -1,9 +1,11 @@
 from app import app
 from app.models.onionoo_connector import OnionooConnector
-from app.controllers.tshirt_validator import check_tshirt
+from app.controllers.tshirt_validator import check_tshirts
+from app.models.relay import format_time
 from difflib import SequenceMatcher
 
-import datetime
+import datetime, time
+from global_vars import tshirt_processes
 
 # Implementation of the Singleton class
 class Singleton(type):
@@ -14,6 +16,44 @@ class Singleton(type):
             cls._instances[cls] = super(Singleton, cls).__call__(*args, **kwargs)
         return cls._instances[cls]
 
+class DisjointSet(object):
+    """
+        Union-find over the integers 0..size-1, with union by rank and path halving
+    """
+    def __init__(self, size):
+        self.parent = range(size)
+        self.rank = [0] * size
+
+    def find(self, i):
+        parent = self.parent
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(self, i, j):
+        i, j = self.find(i), self.find(j)
+        if i == j:
+            return i
+        if self.rank[i] < self.rank[j]:
+            i, j = j, i
+        self.parent[j] = i
+        if self.rank[i] == self.rank[j]:
+            self.rank[i] += 1
+        return i
+
+    def groups(self):
+        """ Returns the sets as lists of members, ordered by their smallest member """
+        groups = {}
+        order = []
+        for i in range(len(self.parent)):
+            root = self.find(i)
+            if root not in groups:
+                groups[root] = []
+                order.append(root)
+            groups[root].append(i)
+        return [groups[root] for root in order]
+
 """
     This class gets relay data from Onionoo using an OnionooConnector instance
     and groups them together into relays
@@ -22,10 +62,25 @@ class FamilyAggregator(object):
     # FamilyAggregator should be a singleton
     __metaclass__ = Singleton
 
-    def __init__(self):
+    def __init__(self, snapshot=None):
+        """
+            snapshot is an optional RankingSnapshot. It is diffed against the fetched
+            relays, and if it holds a previous run, only touched families are regrouped
+        """
         self.c = OnionooConnector("details", "uptime", "bandwidth")
         self.relays = self.c.details_relays
+        self.snapshot = snapshot
+        if self.snapshot is not None:
+            self.snapshot.diff(self.relays)
+
+        # The t-shirt pass runs once over all relays, before and apart from grouping
+        start = time.time()
+        self.tshirts = check_tshirts(self.c, tshirt_processes)
+        print "[FamilyAggregator] T-shirt eligibility took %.2fs" % (time.time() - start)
+
+        start = time.time()
         self.families = self.group_by_family()
+        print "[FamilyAggregator] Grouping took %.2fs" % (time.time() - start)
 
     # Getters
     def get_relays(self):
@@ -40,7 +95,7 @@ class FamilyAggregator(object):
     def get_num_families(self):
         return len(self.families)
 
-    # Helper functions for sieve algorithm
+    # Helper functions for building the family aggregates
     def fill_in(self, relay, details, family):
         for detail in details:
             family[detail] += relay.setdefault(detail, 0)
@@ -58,165 +113,209 @@ class FamilyAggregator(object):
             words.remove("bitcoin")
         return (address, " ".join(words))
 
-    def filter_fingerprints(self, relay, family):
-        temp = relay
-        new_fam = []
-        if "extended_family" in temp:
-            for fingerprint in temp["extended_family"]:
-                if "$" + temp["fingerprint"] == fingerprint:
-                    if family != "":
-                        continue
-                elif len(fingerprint) < 41:
-                    continue
-                elif len(fingerprint) > 41:
-                    new_fam.append(fingerprint[:41])
-                    continue
-                else:
-                    for char in fingerprint[1:].upper():
-                        if not ("0" <= char <= "9" or "A" <= char <= "F"):
-                            continue
-                new_fam.append(fingerprint)
-        else:
-            return temp
-        temp["extended_family"] = new_fam
-        return temp
-
     def has_duplicate_contacts(self, relay, family):
         for contact in family["contact"]:
             if SequenceMatcher(None, contact, relay["contact"]).ratio() > 0.8:
                 return True
         return False
 
-    # Sieve algorithm
+    # Family resolution
+    def extended_family(self, relay):
+        """ Effective and indirect family members of a relay, computed once """
+        if "extended_family" not in relay:
+            relay["extended_family"] = relay.setdefault("effective_family", []) + relay.setdefault("indirect_family", [])
+        return relay["extended_family"]
+
+    def family_member(self, fingerprint, index):
+        """ Index of a relay listed in an extended family, or None if it is not running """
+        # Family entries look like $FINGERPRINT, possibly followed by a nickname
+        return index.get(fingerprint[1:41].upper())
+
+    def resolve_families(self):
+        """
+            Groups the indices of self.relays into families. Two relays are in the
+            same family if either one lists the other in its extended family.
+            Families and their members keep the order in which they appear in self.relays
+        """
+        relays = self.relays
+
+        # Fingerprint index, built once
+        index = {}
+        for i, relay in enumerate(relays):
+            index[relay["fingerprint"]] = i
+
+        if self.snapshot is not None and self.snapshot.incremental:
+            return self.resolve_touched_families(index)
+
+        components = DisjointSet(len(relays))
+        for i, relay in enumerate(relays):
+            for fingerprint in self.extended_family(relay):
+                j = self.family_member(fingerprint, index)
+                if j is not None:
+                    components.union(i, j)
+
+        return components.groups()
+
+    def resolve_touched_families(self, index):
+        """
+            Same as resolve_families, but keeps the families of the previous run that
+            no added, removed or changed relay belongs to, and only regroups the rest
+        """
+        relays = self.relays
+        touched = set(index[fingerprint] for fingerprint in self.snapshot.touched() if fingerprint in index)
+
+        # Previous families, as indices into relays
+        previous = {}
+        for fingerprints in self.snapshot.families:
+            members = sorted(index[fingerprint] for fingerprint in fingerprints if fingerprint in index)
+            if len(members) < len(fingerprints) or any(i in touched for i in members):
+                touched.update(members)
+            else:
+                for i in members:
+                    previous[i] = members
+
+        # Relays missing from the previous families are regrouped as well
+        touched.update(i for i in range(len(relays)) if i not in previous)
+
+        # An unchanged relay may list a relay that was not running before, which
+        # links the two families now
+        added = set(index[fingerprint] for fingerprint in self.snapshot.added)
+        for i in previous.keys():
+            if i in previous and any(self.family_member(fingerprint, index) in added
+                                     for fingerprint in self.extended_family(relays[i])):
+                for k in previous.pop(i):
+                    previous.pop(k, None)
+                    touched.add(k)
+
+        # Touched relays can link to untouched families, which then need regrouping too
+        queue = list(touched)
+        while queue:
+            i = queue.pop()
+            for fingerprint in self.extended_family(relays[i]):
+                j = self.family_member(fingerprint, index)
+                if j is None or j in touched:
+                    continue
+                for k in previous.pop(j, [j]):
+                    previous.pop(k, None)
+                    touched.add(k)
+                    queue.append(k)
+
+        touched = sorted(touched)
+        position = dict((i, p) for p, i in enumerate(touched))
+        components = DisjointSet(len(touched))
+        for p, i in enumerate(touched):
+            for fingerprint in self.extended_family(relays[i]):
+                j = self.family_member(fingerprint, index)
+                if j is not None:
+                    components.union(p, position[j])
+
+        groups = [[touched[p] for p in group] for group in components.groups()]
+        kept = dict((members[0], members) for members in previous.values())
+        groups.extend(kept.values())
+        print "[resolve_families] Kept %d families, regrouped %d relays" % (len(kept), len(touched))
+        return sorted(groups, key=lambda members: members[0])
+
+    def new_family(self):
+        return {"observed_bandwidth": 0,
+                "exit_bandwidth": 0,
+                "consensus_weight_fraction": 0,
+                "consensus_weight": 0,
+                "families": [], "contact": [],
+                "middle_probability": 0,
+                "exit_probability": 0, "bitcoin_addr": "None",
+                "bandwidth_points": 0, "consensus_points": 0,
+                "last_seen": str(datetime.datetime.now()), "maximum_uptime": str(datetime.datetime.now()),
+                "countries": [], "exit": 0, "guard": 0,
+                "t_shirts": [],
+                "eligible_for_tshirt": False}
+
+    def add_to_family(self, relay, family):
+        """ Adds a relay to the family and updates the aggregate fields """
+        family["families"].append(relay)
+        self.fill_in(relay, ["middle_probability", "exit_probability", "observed_bandwidth", "consensus_weight", "consensus_weight_fraction"], family)
+
+        if "country" in relay and relay["country"] not in family["countries"]:
+            family["countries"].append(relay["country"])
+
+        if self.tshirts.get(relay["fingerprint"], False):
+            family["t_shirts"].append(relay["fingerprint"])
+            family["eligible_for_tshirt"] = True
+
+        if relay.has_flag("Exit"):
+            family["exit"] += 1
+            family["exit_bandwidth"] += relay["exit_probability"] * relay["observed_bandwidth"]
+
+        if relay.has_flag("Guard"):
+            family["guard"] += 1
+
+    def set_family_times(self, members, family):
+        """ Oldest first_seen and last_restarted of the members, compared as epoch seconds """
+        first_seen = [relay.first_seen for relay in members if "first_seen" in relay]
+        if len(first_seen) > 0:
+            family["first_seen"] = format_time(min(first_seen))
+
+        last_restarted = [relay.last_restarted for relay in members if "last_restarted" in relay]
+        if len(last_restarted) > 0:
+            family["maximum_uptime"] = format_time(min(last_restarted))
+
+    def build_contacts(self, members, family):
+        """ Adds the relays at the member indices to the family, collecting distinct contacts """
+        relays = self.relays
+
+        # The first relay of the family provides the contact and bitcoin address
+        head = relays[members[0]]
+        bitcoin_addr, contact = self.parse_bitcoin(head.setdefault("contact", ""))
+        if bitcoin_addr != "":
+            family["bitcoin_addr"] = bitcoin_addr
+        family["contact"].append(contact)
+
+        self.add_to_family(head, family)
+
+        for i in members[1:]:
+            relay = relays[i]
+            if "contact" in relay and not self.has_duplicate_contacts(relay, family):
+                family["contact"].append(relay["contact"])
+            self.add_to_family(relay, family)
+
+        family["contact"] = sorted(family["contact"])
+
     def group_by_family(self):
         # For storing the families
         families = []
 
         relays = self.relays
 
-        # This number will be used for the sieve algorithm later
-        num_relays = len(relays)
-
-        # Initialization - set all flags to false
-        all_relays = [[relay, False] for relay in relays]
-
-        badges = {
-            "bandwidth": 0,
-            "exit_bandwidth": 0,
-            "consensus_weight": 0,
-            "num_countries": 0,
-            "num_relays": 0,
-            "age_of_family": 0,
-            "maximum_uptime": 0,
-            "has_contact_for_half": 0,
-            "has_guard_for_half": 0,
-            "rank": 0,
-            "runs_recommended_tor": 0,
-            "liberal_exit:": 0,
-            "rare_countries": 0,
-            "geo_diversity": 0
-        }
-
-        print "[group_by_family] Begin sieve"
-
-        for i in range(num_relays):
-            # bef_relay is the relay before its fingerprints in the family
-            # field are filtered
-            bef_relay, visited = all_relays[i]
-
-            if visited:
-                continue
+        print "[group_by_family] Begin family resolution"
+
+        reused = 0
+        for members in self.resolve_families():
+            family = self.new_family()
+            fingerprints = [relays[i]["fingerprint"] for i in members]
+
+            # Families untouched since the previous run keep their contacts, which
+            # are the costly part to rebuild. The sums are always recomputed
+            cached = self.snapshot.cached_contacts(fingerprints) if self.snapshot is not None else None
+            if cached is not None:
+                family["contact"], family["bitcoin_addr"] = cached
+                relays[members[0]].setdefault("contact", "")
+                for i in members:
+                    self.add_to_family(relays[i], family)
+                reused += 1
             else:
-                # Mark as visited
-                all_relays[i][1] = True
-
-                # Init of family dictionary
-                family = {"observed_bandwidth": 0,
-                          "exit_bandwidth": 0,
-                          "consensus_weight_fraction": 0,
-                          "consensus_weight": 0,
-                          "families": [], "contact": [],
-                          "middle_probability": 0,
-                          "exit_probability": 0, "bitcoin_addr": "None",
-                          "bandwidth_points": 0, "consensus_points": 0,
-                          "last_seen": str(datetime.datetime.now()), "maximum_uptime": str(datetime.datetime.now()),
-                          "countries": [], "exit": 0, "guard": 0,
-                          "t_shirts": [],
-                          "eligible_for_tshirt": False}
-
-                relay = self.filter_fingerprints(bef_relay, family)
-                family["families"].append(relay)
-
-                if "Exit" in relay:
-                    family["exit"] += 1
-                    family["exit_bandwidth"] += relay["observed_bandwidth"] * relay["exit_probability"]
-
-                if "Guard" in relay:
-                    family["guard"] += 1
-
-                if "country" in relay:
-                    family["countries"].append(relay["country"])
-
-                if "first_seen" in relay:
-                    family["first_seen"] = relay["first_seen"]
-
-                if "last_seen" in relay:
-                    family["maximum_uptime"] = relay["last_restarted"]
-
-                if check_tshirt(relay["fingerprint"], self.c):
-                    family["t_shirts"].append(relay["fingerprint"])
-                    family["eligible_for_tshirt"] = True
-
-                # Used for checking if relay is related to other relays
-                fingerprint = "$" + relay["fingerprint"]
-
-                self.fill_in(relay, ["middle_probability", "exit_probability", "observed_bandwidth", "consensus_weight", "consensus_weight_fraction"], family)
-
-                bitcoin_addr, contact = self.parse_bitcoin(relay.setdefault("contact", ""))
-                if bitcoin_addr != "":
-                    family["bitcoin_addr"] = bitcoin_addr
-                family["contact"].append(contact)
-
-                relay["extended_family"] = relay.setdefault("effective_family", []) + relay.setdefault("indirect_family", [])
-
-                if "extended_family" in relay:
-                    for j in range(num_relays):
-                        other_relay, other_visited = all_relays[j]
-                        other_relay["extended_family"] = other_relay.setdefault("effective_family", []) + other_relay.setdefault("indirect_family", [])
-                        if other_visited:
-                            continue
-                        else:
-                            if "extended_family" in other_relay and fingerprint in other_relay["extended_family"] or "$" + other_relay["fingerprint"] in relay["extended_family"]:
-                                family["families"].append(other_relay)
-                                self.fill_in(other_relay, ["middle_probability", "exit_probability", "observed_bandwidth", "consensus_weight", "consensus_weight_fraction"], family)
-                                if "country" in other_relay and other_relay["country"] not in family["countries"]:
-                                    family["countries"].append(other_relay["country"])
-                                if check_tshirt(other_relay["fingerprint"], self.c):
-                                    family["t_shirts"].append(other_relay["fingerprint"])
-                                    family["eligible_for_tshirt"] = True
-                                if "Exit" in other_relay["flags"]:
-                                    family["exit"] += 1
-                                    family["exit_bandwidth"] += other_relay["exit_probability"] * other_relay["observed_bandwidth"]
-                                if "Guard" in other_relay["flags"]:
-                                    family["guard"] += 1
-                                if "contact" in other_relay and not self.has_duplicate_contacts(other_relay, family):
-                                    family["contact"].append(other_relay["contact"])
-                                if "first_seen" in other_relay:
-                                    if datetime.datetime.strptime(other_relay["first_seen"], "%Y-%m-%d %H:%M:%S") < datetime.datetime.strptime(family["first_seen"], "%Y-%m-%d %H:%M:%S"):
-                                        family["first_seen"] = other_relay["first_seen"]
-                                if "last_restarted" in other_relay:
-                                    if datetime.datetime.strptime(other_relay["last_restarted"], "%Y-%m-%d %H:%M:%S") < datetime.datetime.strptime(family["maximum_uptime"], "%Y-%m-%d %H:%M:%S"):
-                                        family["maximum_uptime"] = other_relay["last_restarted"]
-                                all_relays[j][1] = True
-
-                family["families"] = sorted(family["families"], key=lambda relay: relay["observed_bandwidth"], reverse=True)
-                family["bandwidth_points"] = family["observed_bandwidth"] + family["observed_bandwidth"] * family["exit_probability"]
-                family["consensus_points"] = family["consensus_weight"] + 1200 * family["exit_probability"]
-                family["contact"] = sorted(family["contact"])
-
-                families.append(family)
-
-        # End sieve
-        print "[group_by_family] End sieve"
+                self.build_contacts(members, family)
+
+            if self.snapshot is not None:
+                self.snapshot.store_contacts(fingerprints, family["contact"], family["bitcoin_addr"])
+
+            self.set_family_times(family["families"], family)
+
+            family["families"] = sorted(family["families"], key=lambda relay: relay["observed_bandwidth"], reverse=True)
+            family["bandwidth_points"] = family["observed_bandwidth"] + family["observed_bandwidth"] * family["exit_probability"]
+            family["consensus_points"] = family["consensus_weight"] + 1200 * family["exit_probability"]
+
+            families.append(family)
+
+        print "[group_by_family] Reused the contacts of %d families" % reused
+        print "[group_by_family] End family resolution"
 
         return families
@@ -6,7 +6,23 @@
 """
 
 from app import app
-import httplib2, json
+from app.models.onionoo_fetcher import OnionooFetcher
+from app.models.relay import Relay, parse_time
+
+# Keys of the uptime and bandwidth documents that hold history objects
+HISTORY_KEYS = ["uptime", "write_history", "read_history"]
+
+def normalize_history(relay):
+    """
+        Converts the first and last timestamps of every history object of an uptime
+        or bandwidth relay to epoch seconds, so they are parsed only once
+    """
+    for key in HISTORY_KEYS:
+        for history in relay.get(key, {}).values():
+            for field in ["first", "last"]:
+                if field in history:
+                    history[field] = parse_time(history[field])
+    return relay
 
 class OnionooConnector(object):
 
@@ -18,41 +34,61 @@ class OnionooConnector(object):
     """
     def __init__(self, *documents):
         self.details_relays, self.uptime_relays, self.bandwidth_relays = "", "", ""
-        if "details" in documents:
-            self.details_relays = self.fetch_data("details")
-        if "uptime" in documents:
-            self.uptime_relays = self.fetch_data("uptime")
-        if "bandwidth" in documents:
-            self.bandwidth_relays = self.fetch_data("bandwidth")
+        # Fingerprint-keyed index of each fetched document
+        self.indexes = {"details": {}, "uptime": {}, "bandwidth": {}}
+        # Relays of the details document are kept as compact Relay records, and the
+        # timestamps of every document are converted to epoch seconds right after fetching
+        self.fetcher = OnionooFetcher(records={"details": Relay, "uptime": normalize_history, "bandwidth": normalize_history})
+
+        # Download the requested documents concurrently
+        fetched = self.fetcher.fetch_all([document for document in ["details", "uptime", "bandwidth"] if document in documents])
+        for document, relays in fetched.items():
+            setattr(self, document + "_relays", relays)
+
+        for document in self.indexes:
+            self.indexes[document] = self.build_index(getattr(self, document + "_relays"))
 
     """
-        Makes GET request to the Onionoo API and returns the response's content.
+        Returns the relays of a single Onionoo document.
     """
     def fetch_data(self, data):
-        h = httplib2.Http(".cache")
-
         print "[fetch_data] Getting json data via onionoo"
-        url = "https://onionoo.torproject.org/{type}?running=true".format(type=data)
-        print "[fetch_data] Making request to %s" % url
-        resp, content = h.request(url, "GET")
+        return self.fetcher.fetch(data)
 
-        return self.convert_from_raw(content)
+    def build_index(self, relays):
+        """ Turn a list of relays into a dict keyed by fingerprint """
+        res = {}
+        for relay in relays:
+            res[relay["fingerprint"]] = relay
+        return res
 
-    """
-        Converts content from fetch_data to json
-    """
-    def convert_from_raw(self, content):
-        json_data = json.loads(content)
-        return json_data["relays"]
+    def index_of(self, relays):
+        """ Returns the index built for relays if it is one of the fetched documents """
+        for document, index in self.indexes.items():
+            if relays is getattr(self, document + "_relays"):
+                return index
+        return None
 
     def find_by_fingerprint(self, relays, fingerprint):
+        index = self.index_of(relays)
+        if index is not None:
+            return index.get(fingerprint)
         for relay in relays:
             if relay["fingerprint"] == fingerprint:
                 return relay
 
+    def find_documents(self, fingerprint):
+        """
+            Looks up a relay in the details, uptime and bandwidth documents at once.
+            Returns a (details, uptime, bandwidth) tuple, with None for missing entries
+        """
+        return (self.indexes["details"].get(fingerprint),
+                self.indexes["uptime"].get(fingerprint),
+                self.indexes["bandwidth"].get(fingerprint))
+
     def dictify_relays(self, relays):
         """ Turn a list of relays into a dict for easy retrieval """
-        res = {}
-        for relay in relays:
-            res[relay["fingerprint"]] = relay
-        return res
+        index = self.index_of(relays)
+        if index is not None:
+            return index
+        return self.build_index(relays)
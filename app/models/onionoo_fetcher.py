@@ -0,0 +1,225 @@
+"""
+    OnionooFetcher downloads Onionoo documents concurrently.
+    Every document is cached on disk together with its ETag and Last-Modified
+    validators. Later requests send If-None-Match and If-Modified-Since, so an
+    unchanged document is answered with 304 Not Modified and served from the cache.
+    Parsed documents are also kept in memory, so a 304 does not re-parse them either.
+    The base url can be pointed at a local server through the ONIONOO_URL variable.
+
+    Documents are streamed to the cache and the relays array is parsed one relay at
+    a time, keeping only the fields and history periods that Roster reads. The raw document is never held
+    in memory next to its parsed form.
+"""
+
+import os, re, json, zlib, threading, urllib2
+from concurrent.futures import ThreadPoolExecutor
+from app.models.relay import Relay
+
+ONIONOO_URL = os.environ.get("ONIONOO_URL", "https://onionoo.torproject.org")
+
+CHUNK_SIZE = 64 * 1024
+
+# Fields read by relay_rank.py, tshirt_validator, RelayStatsAggregator and the templates
+PIPELINE_FIELDS = {
+    "details": list(Relay.ONIONOO_FIELDS),
+    "uptime": ["fingerprint", "uptime"],
+    "bandwidth": ["fingerprint", "write_history"]
+}
+
+# History periods read by tshirt_validator. The other periods of these history
+# objects are dropped while parsing
+HISTORY_PERIODS = {
+    "uptime": ["3_months"],
+    "write_history": ["3_months"]
+}
+
+RELAYS_START = re.compile(r'"relays"\s*:\s*\[')
+WHITESPACE = re.compile(r'[\s,]*')
+
+def iter_relays(fp, fields=None, periods=None, chunk_size=CHUNK_SIZE):
+    """
+        Parses the relays array of an Onionoo document from a file object incrementally
+        and yields the relays one by one. If fields is given, only those keys are kept.
+        If periods is given, history objects only keep the listed periods.
+    """
+    decoder = json.JSONDecoder()
+    buf = ""
+    eof = False
+
+    # Skip to the start of the relays array
+    while True:
+        match = RELAYS_START.search(buf)
+        if match is not None:
+            buf = buf[match.end():]
+            break
+        if eof:
+            return
+        chunk = fp.read(chunk_size)
+        eof = chunk == ""
+        # Keep a tail in case the key is split across chunks
+        buf = buf[-32:] + chunk
+
+    pos = 0
+    while True:
+        pos = WHITESPACE.match(buf, pos).end()
+        if pos < len(buf) and buf[pos] == "]":
+            return
+        try:
+            if pos == len(buf):
+                raise ValueError("Need more data")
+            relay, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            if eof:
+                raise ValueError("Truncated Onionoo document")
+            chunk = fp.read(chunk_size)
+            eof = chunk == ""
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+        pos = end
+        if fields is not None:
+            relay = dict((key, relay[key]) for key in fields if key in relay)
+        if periods is not None:
+            for key, keep in periods.items():
+                if isinstance(relay.get(key), dict):
+                    relay[key] = dict((period, relay[key][period]) for period in keep if period in relay[key])
+        yield relay
+
+class OnionooFetcher(object):
+
+    # Parsed documents shared by all fetchers: url => (version, relays). Only the
+    # latest version of each url is kept
+    parsed = {}
+    parsed_lock = threading.Lock()
+
+    def __init__(self, base_url=ONIONOO_URL, cache_dir=".cache/onionoo", max_workers=3, fields=PIPELINE_FIELDS,
+                 periods=HISTORY_PERIODS, records={}):
+        self.base_url = base_url.rstrip("/")
+        # document => fields to keep, or None to keep whole relays
+        self.fields = fields
+        # history key => periods to keep, or None to keep every period
+        self.periods = periods
+        # document => type that parsed relays are converted to, such as Relay
+        self.records = records
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def url_for(self, document):
+        return "{base}/{type}?running=true".format(base=self.base_url, type=document)
+
+    def cache_paths(self, document):
+        """ Returns the paths of the cached body and its validators """
+        body_path = os.path.join(self.cache_dir, document + ".json")
+        return (body_path, body_path + ".meta")
+
+    def load_meta(self, document):
+        body_path, meta_path = self.cache_paths(document)
+        if not os.path.exists(body_path) or not os.path.exists(meta_path):
+            return {}
+        with open(meta_path, "r") as fp:
+            return json.load(fp)
+
+    def store(self, document, response, meta):
+        """ Streams the response body to the cache and writes its validators """
+        body_path, meta_path = self.cache_paths(document)
+
+        # Onionoo answers with gzip when asked to, so decompress on the fly
+        decompressor = None
+        if response.info().getheader("Content-Encoding") == "gzip":
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        with open(body_path + ".tmp", "wb") as fp:
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if chunk == "":
+                    break
+                if decompressor is not None:
+                    chunk = decompressor.decompress(chunk)
+                fp.write(chunk)
+            if decompressor is not None:
+                fp.write(decompressor.flush())
+
+        with open(meta_path + ".tmp", "w") as fp:
+            fp.write(json.dumps(meta))
+
+        # Replace the old cache entry only once the whole body has arrived
+        os.rename(body_path + ".tmp", body_path)
+        os.rename(meta_path + ".tmp", meta_path)
+
+    def validator(self, meta):
+        return meta.get("etag") or meta.get("last_modified")
+
+    def document_fields(self, document):
+        if self.fields is None:
+            return None
+        return self.fields.get(document)
+
+    def load_cached(self, document, url, meta):
+        """
+            Returns the parsed relays of a cached document, parsing it only once per
+            version. A version is identified by the document's validator and the cache
+            file's mtime and size. Documents without a validator are parsed every time
+        """
+        fields = self.document_fields(document)
+        record = self.records.get(document)
+        periods = tuple(sorted((key, tuple(keep)) for key, keep in (self.periods or {}).items()))
+        body_path = self.cache_paths(document)[0]
+        stat = os.stat(body_path)
+        validator = self.validator(meta)
+        version = (validator, stat.st_mtime, stat.st_size, tuple(fields or []), periods, record)
+
+        if validator is not None:
+            with self.parsed_lock:
+                entry = self.parsed.get(url)
+            if entry is not None and entry[0] == version:
+                return entry[1]
+
+        with open(body_path, "rb") as fp:
+            if record is None:
+                relays = list(iter_relays(fp, fields, self.periods))
+            else:
+                relays = [record(relay) for relay in iter_relays(fp, fields, self.periods)]
+        with self.parsed_lock:
+            if validator is not None:
+                self.parsed[url] = (version, relays)
+            else:
+                self.parsed.pop(url, None)
+        return relays
+
+    def fetch(self, document):
+        """ Returns the relays of an Onionoo document, using the cache when it is unchanged """
+        url = self.url_for(document)
+        meta = self.load_meta(document)
+
+        request = urllib2.Request(url, headers={"Accept-Encoding": "gzip"})
+        if meta.get("etag"):
+            request.add_header("If-None-Match", meta["etag"])
+        if meta.get("last_modified"):
+            request.add_header("If-Modified-Since", meta["last_modified"])
+
+        print "[fetch] Making request to %s" % url
+        try:
+            response = urllib2.urlopen(request)
+        except urllib2.HTTPError, error:
+            if error.code != 304 or not meta:
+                raise
+            print "[fetch] %s not modified, using cache" % document
+            return self.load_cached(document, url, meta)
+
+        meta = {"etag": response.info().getheader("ETag"),
+                "last_modified": response.info().getheader("Last-Modified")}
+        self.store(document, response, meta)
+        return self.load_cached(document, url, meta)
+
+    def fetch_all(self, documents):
+        """ Fetches the documents concurrently and returns a dict of document => relays """
+        documents = list(documents)
+        if len(documents) == 0:
+            return {}
+        executor = ThreadPoolExecutor(max_workers=min(self.max_workers, len(documents)))
+        try:
+            return dict(zip(documents, executor.map(self.fetch, documents)))
+        finally:
+            executor.shutdown()
@@ -0,0 +1,40 @@
+"""
+    PrefixIndex answers prefix searches over relay fingerprints and nicknames.
+    Fingerprints (upper case) and nicknames (lower case) are kept in one sorted
+    array, so a search is a binary search followed by a short scan.
+"""
+
+import bisect
+
+class PrefixIndex(object):
+
+    def __init__(self, relays):
+        """ relays is a list of dicts with fingerprint and nickname keys """
+        entries = []
+        for i, relay in enumerate(relays):
+            entries.append((relay["fingerprint"].upper(), i))
+            if relay.get("nickname"):
+                entries.append((relay["nickname"].lower(), i))
+        entries.sort()
+
+        self.relays = relays
+        self.keys = [key for key, i in entries]
+        self.ids = [i for key, i in entries]
+
+    def search(self, query, limit=10):
+        """ Returns up to limit relays whose fingerprint or nickname starts with query """
+        query = query.strip().lstrip("$")
+        if query == "":
+            return []
+
+        results = []
+        seen = set()
+        # Fingerprints match the upper case query, nicknames the lower case one
+        for prefix in sorted(set([query.upper(), query.lower()])):
+            pos = bisect.bisect_left(self.keys, prefix)
+            while pos < len(self.keys) and len(results) < limit and self.keys[pos].startswith(prefix):
+                if self.ids[pos] not in seen:
+                    seen.add(self.ids[pos])
+                    results.append(self.relays[self.ids[pos]])
+                pos += 1
+        return results
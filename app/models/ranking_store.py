@@ -0,0 +1,135 @@
+"""
+    RankingStore keeps the ranking artifacts written by relay_rank.py
+    (top10_bandwidth.json, top10_consensus.json, all.json, family_manifest.json and
+    the per-metric rank arrays in rankings.json)
+    in memory for the views. Family dashboards are read from the small per-family
+    detail document that the manifest points to.
+    Each artifact is loaded once and reloaded only when it changes. Under the LOCAL
+    strategy changes are detected by the file's mtime, under REMOTE by the ETag of
+    the S3 object, which is checked at most once every check_interval seconds.
+"""
+
+import os, json, time, calendar, threading
+from datetime import datetime
+from email.utils import parsedate
+
+import boto
+
+from global_vars import *
+from app.models.prefix_index import PrefixIndex
+
+class RankingStore(object):
+
+    artifacts = ["top10_bandwidth", "top10_consensus", "all", "family_manifest", "rankings"]
+
+    def __init__(self, strategy=static_store_strategy, check_interval=60):
+        self.strategy = strategy
+        self.check_interval = check_interval if strategy == "REMOTE" else 0
+        self.lock = threading.Lock()
+        self.bucket = None
+        self.last_check = 0
+        # artifact => (version, parsed json)
+        self.documents = {}
+        # artifact => time it was written, in epoch seconds
+        self.modified = {}
+        # Fingerprint and nickname of every relay, and the search index over them
+        self.relay_list = []
+        self.search_index = PrefixIndex([])
+
+    def get_bucket(self):
+        """ Reuses a single S3 connection for all requests """
+        if self.bucket is None:
+            c = boto.connect_s3(acc_key, acc_sec)
+            self.bucket = c.get_bucket(bucket)
+        return self.bucket
+
+    def current_version(self, artifact):
+        """ Returns the artifact's version and the time it was written """
+        if self.strategy == "LOCAL":
+            mtime = os.path.getmtime(abs_paths[artifact])
+            return (mtime, mtime)
+        key = self.get_bucket().get_key(artifact + ".json")
+        return (key.etag, calendar.timegm(parsedate(key.last_modified)))
+
+    def load(self, artifact):
+        print "[RankingStore] Loading %s" % artifact
+        if self.strategy == "LOCAL":
+            with open(abs_paths[artifact], "r") as fp:
+                return json.load(fp)
+        return json.loads(self.get_bucket().get_key(artifact + ".json").get_contents_as_string())
+
+    def flatten_relays(self, families):
+        """ Flattens the families into the compact relay list used for search """
+        return [{"fingerprint": relay["fingerprint"], "nickname": relay.get("nickname", "")}
+                for family in families for relay in family["families"]]
+
+    def refresh(self):
+        """ Reloads the artifacts that changed since they were last loaded """
+        now = time.time()
+        if self.documents and now - self.last_check < self.check_interval:
+            return
+        with self.lock:
+            self.last_check = now
+            for artifact in self.artifacts:
+                version, self.modified[artifact] = self.current_version(artifact)
+                if artifact in self.documents and self.documents[artifact][0] == version:
+                    continue
+                self.documents[artifact] = (version, self.load(artifact))
+                if artifact == "all":
+                    self.relay_list = self.flatten_relays(self.documents["all"][1])
+                    self.search_index = PrefixIndex(self.relay_list)
+
+    def get(self, artifact):
+        self.refresh()
+        return self.documents[artifact][1]
+
+    def search(self, query, limit=10):
+        """ Relays whose fingerprint or nickname starts with query """
+        self.refresh()
+        return self.search_index.search(query, limit)
+
+    def version(self):
+        """ Identifies the currently loaded snapshot of the rankings """
+        self.refresh()
+        return tuple(self.documents[artifact][0] for artifact in self.artifacts)
+
+    def last_modified(self):
+        """ Time the newest artifact of the current snapshot was written """
+        self.refresh()
+        return datetime.utcfromtimestamp(int(max(self.modified.values())))
+
+    def find_shard(self, fingerprint):
+        """ Name of the detail document of the fingerprint's family, or None """
+        return self.get("family_manifest").get(fingerprint)
+
+    def read_shard(self, shard):
+        """ Contents of a detail document, or None if it does not exist """
+        if self.strategy == "LOCAL":
+            path = os.path.join(abs_paths["family_details"], shard + ".json")
+            if not os.path.exists(path):
+                return None
+            with open(path, "r") as fp:
+                return fp.read()
+        key = self.get_bucket().get_key("families/" + shard + ".json")
+        if key is None:
+            return None
+        return key.get_contents_as_string()
+
+    def find_family_detail(self, fingerprint):
+        """
+            Returns the detail document of the fingerprint's family, a dict with the
+            family and its map markers, or "" if the fingerprint is unknown
+        """
+        shard = self.find_shard(fingerprint)
+        if shard is None:
+            return ""
+        data = self.read_shard(shard)
+        if data is None:
+            # The loaded manifest predates a run that removed the document, so
+            # reload it before giving up
+            self.last_check = 0
+            shard = self.find_shard(fingerprint)
+            data = self.read_shard(shard) if shard is not None else None
+            if data is None:
+                return ""
+        return json.loads(data)
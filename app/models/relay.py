@@ -0,0 +1,119 @@
+"""
+    Relay is a compact record for a relay from the Onionoo details document.
+    It only holds the fields that Roster uses, stores timestamps as epoch seconds
+    and flags as a bitmask, and supports the dict operations the pipeline relies on
+    (relay["key"], "key" in relay, get, setdefault), so it can stand in for the
+    Onionoo dict. to_dict turns it back into the Onionoo JSON shape.
+"""
+
+import calendar, time
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+# Bit positions of the relay flags. Flags that are not listed here get a bit
+# assigned the first time they are seen
+FLAG_NAMES = ["Authority", "BadExit", "Exit", "Fast", "Guard", "HSDir", "Running", "Stable", "V2Dir", "Valid"]
+FLAG_BITS = dict((flag, 1 << i) for i, flag in enumerate(FLAG_NAMES))
+
+def flag_bit(flag):
+    if flag not in FLAG_BITS:
+        FLAG_BITS[flag] = 1 << len(FLAG_NAMES)
+        FLAG_NAMES.append(flag)
+    return FLAG_BITS[flag]
+
+def parse_time(string):
+    """ Converts an Onionoo timestamp to epoch seconds """
+    return calendar.timegm(time.strptime(string, TIME_FORMAT))
+
+def format_time(epoch):
+    """ Converts epoch seconds back to an Onionoo timestamp """
+    return time.strftime(TIME_FORMAT, time.gmtime(epoch))
+
+class Relay(object):
+
+    # Fields read from the Onionoo details document
+    ONIONOO_FIELDS = ("fingerprint", "nickname", "flags", "contact", "country", "country_name",
+                      "as_number", "or_addresses", "host_name", "platform", "recommended_version",
+                      "first_seen", "last_seen", "last_restarted", "latitude", "longitude",
+                      "observed_bandwidth", "consensus_weight", "consensus_weight_fraction",
+                      "middle_probability", "exit_probability", "guard_probability",
+                      "exit_policy", "exit_policy_summary", "effective_family", "indirect_family",
+                      "alleged_family")
+
+    # Fields added by Roster
+    ROSTER_FIELDS = ("extended_family", "uuid", "runs_recommended_tor")
+
+    FIELDS = ONIONOO_FIELDS + ROSTER_FIELDS
+
+    TIME_FIELDS = frozenset(["first_seen", "last_seen", "last_restarted"])
+
+    __slots__ = FIELDS
+
+    def __init__(self, relay):
+        for key, value in relay.items():
+            if key in Relay.FIELDS:
+                self[key] = value
+
+    def has_flag(self, flag):
+        return getattr(self, "flags", 0) & FLAG_BITS.get(flag, 0) != 0
+
+    # Dict protocol
+    def __getitem__(self, key):
+        try:
+            value = getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+        if key == "flags":
+            return [flag for flag in FLAG_NAMES if value & FLAG_BITS[flag]]
+        if key in Relay.TIME_FIELDS:
+            return format_time(value)
+        return value
+
+    def __setitem__(self, key, value):
+        if key == "flags":
+            bits = 0
+            for flag in value:
+                bits |= flag_bit(flag)
+            value = bits
+        elif key in Relay.TIME_FIELDS:
+            value = parse_time(value)
+        try:
+            setattr(self, key, value)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return key in Relay.FIELDS and hasattr(self, key)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def keys(self):
+        return [key for key in Relay.FIELDS if hasattr(self, key)]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def to_dict(self):
+        return dict(self.items())
+
+    # Slotted classes need explicit state for pickling
+    def __getstate__(self):
+        return dict((key, getattr(self, key)) for key in self.keys())
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
+
+def relay_to_json(obj):
+    """ default hook for json.dumps, so Relays serialize to the Onionoo shape """
+    if isinstance(obj, Relay):
+        return obj.to_dict()
+    raise TypeError(repr(obj) + " is not JSON serializable")
@@ -0,0 +1,144 @@
+"""
+    UUIDStore keeps the uuid of every relay ever tagged and the members of every
+    family uuid in a sqlite database, instead of the fingerprint_to_uuid.json and
+    uuid_to_family.json files that were read and rewritten in full on every run.
+    The time each uuid was minted is kept too, so merged families can keep the
+    oldest one.
+    Families are stored by reference, as the fingerprints of their members; the
+    family data itself is in the per-family detail documents. Writes are batched
+    into one transaction and only touch rows that changed.
+"""
+
+import os, json, sqlite3
+
+from global_vars import *
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS relay_uuids (
+        fingerprint TEXT PRIMARY KEY,
+        uuid TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS uuids (
+        uuid TEXT PRIMARY KEY,
+        created INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS family_members (
+        uuid TEXT NOT NULL,
+        fingerprint TEXT NOT NULL,
+        PRIMARY KEY (uuid, fingerprint)
+    );
+"""
+
+# sqlite allows at most 999 parameters in a statement
+QUERY_CHUNK = 500
+
+def chunks(values, size=QUERY_CHUNK):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+class UUIDStore(object):
+
+    def __init__(self, path=db_abs_paths["uuid_store"]):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(SCHEMA)
+        if self.is_empty():
+            self.import_json()
+
+    def close(self):
+        self.conn.close()
+
+    def is_empty(self):
+        return self.conn.execute("SELECT 1 FROM relay_uuids LIMIT 1").fetchone() is None
+
+    def import_json(self):
+        """ One-time import of the json files the store replaces, if they exist """
+        if os.path.exists(db_abs_paths["fingerprint_to_uuid"]):
+            print "[UUIDStore] Importing fingerprint_to_uuid.json"
+            with open(db_abs_paths["fingerprint_to_uuid"], "r") as fp:
+                self.set_uuids(json.load(fp))
+        if os.path.exists(db_abs_paths["uuid_to_family"]):
+            print "[UUIDStore] Importing uuid_to_family.json"
+            with open(db_abs_paths["uuid_to_family"], "r") as fp:
+                uuid_to_family = json.load(fp)
+            self.set_families(dict((family_uuid, [relay["fingerprint"] for relay in family["families"]])
+                                   for family_uuid, family in uuid_to_family.items()))
+
+    # Relays
+    def get_uuids(self, fingerprints):
+        """ Returns a dict mapping the fingerprints that have a uuid to it """
+        uuids = {}
+        for chunk in chunks(fingerprints):
+            query = "SELECT fingerprint, uuid FROM relay_uuids WHERE fingerprint IN (%s)" % ",".join("?" * len(chunk))
+            uuids.update(self.conn.execute(query, chunk))
+        return uuids
+
+    def set_uuids(self, uuids):
+        """ Upserts a dict of fingerprint => uuid in one transaction """
+        with self.conn:
+            self.write_uuids(uuids)
+
+    def write_uuids(self, uuids):
+        self.conn.executemany("INSERT OR REPLACE INTO relay_uuids (fingerprint, uuid) VALUES (?, ?)", uuids.items())
+
+    def get_created(self, uuids):
+        """
+            Returns a dict mapping uuids to the time they were minted. uuids from
+            before the times were recorded are missing
+        """
+        created = {}
+        for chunk in chunks(uuids):
+            query = "SELECT uuid, created FROM uuids WHERE uuid IN (%s)" % ",".join("?" * len(chunk))
+            created.update(self.conn.execute(query, chunk))
+        return created
+
+    def add_uuids(self, uuids, created):
+        """ Records newly minted uuids in one transaction """
+        with self.conn:
+            self.write_created(uuids, created)
+
+    def write_created(self, uuids, created):
+        self.conn.executemany("INSERT OR IGNORE INTO uuids (uuid, created) VALUES (?, ?)",
+                              [(new_uuid, created) for new_uuid in uuids])
+
+    # Families
+    def get_families(self, family_uuids):
+        """ Returns a dict mapping family uuids to the set of their member fingerprints """
+        families = {}
+        for chunk in chunks(family_uuids):
+            query = "SELECT uuid, fingerprint FROM family_members WHERE uuid IN (%s)" % ",".join("?" * len(chunk))
+            for family_uuid, fingerprint in self.conn.execute(query, chunk):
+                families.setdefault(family_uuid, set()).add(fingerprint)
+        return families
+
+    def set_families(self, families):
+        """
+            Stores a dict of family uuid => member fingerprints in one transaction.
+            Only members that joined or left a family are written
+        """
+        with self.conn:
+            self.write_families(families)
+
+    def write_families(self, families):
+        stored = self.get_families(families.keys())
+        joined, left = [], []
+        for family_uuid, fingerprints in families.items():
+            previous = stored.get(family_uuid, set())
+            joined.extend((family_uuid, fingerprint) for fingerprint in set(fingerprints) - previous)
+            left.extend((family_uuid, fingerprint) for fingerprint in previous - set(fingerprints))
+        self.conn.executemany("DELETE FROM family_members WHERE uuid = ? AND fingerprint = ?", left)
+        self.conn.executemany("INSERT INTO family_members (uuid, fingerprint) VALUES (?, ?)", joined)
+        print "[UUIDStore] %d family members joined, %d left" % (len(joined), len(left))
+
+    # Tagging
+    def commit_tagging(self, minted, created, retagged, families):
+        """
+            Writes the result of a tagging run in one transaction: the newly minted
+            uuids with their creation time, the retagged relays and the family
+            members. A crash leaves the store as it was before the run
+        """
+        with self.conn:
+            self.write_created(minted, created)
+            self.write_uuids(retagged)
+            self.write_families(families)
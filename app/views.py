@@ -4,132 +4,40 @@
 from app import app
 from global_vars import *
 from flask import render_template, redirect, url_for, request, jsonify
-import os, json
-
-import boto
-from boto.s3.key import Key
+import hashlib
 
 from global_vars import static_store_strategy
+from app.models.ranking_store import RankingStore
+from app.models.country_history import CountryHistory
+from app.controllers.response_cache import ResponseCache
 
-@app.route("/", methods=["GET"])
-def index():
-    # Check static_store_strategy. If local, then no need to connect to S3
-    if static_store_strategy == "LOCAL":
-        print "GET /   Going local strategy"
-        data_store = [[],[],[]]
-        file_pairs = [(0, "top10_bandwidth"), (1, "top10_consensus"), (2, "all")]
-        for store_index, file_name in file_pairs:
-            fp = open(abs_paths[file_name], "r")
-            data_store[store_index] = json.load(fp)
-            fp.close()
-
-        # Unpack the families into individual relays
-        all_relays = []
-        for family in data_store[2]:
-            all_relays = all_relays + [relay for relay in family["families"]]
-
-        data_store[2] = all_relays
+# Ranking artifacts, loaded once and refreshed only when they change
+ranking_store = RankingStore()
 
-        return render_template("index.html", top10_bandwidth=data_store[0],
-            top10_consensus=data_store[1], all_relays=data_store[2])
+# Rendered pages, reused until the next ranking snapshot
+response_cache = ResponseCache(ranking_store.version, ranking_store.last_modified)
 
-    # First update the bandwidth and cw rankings using the files from S3
-    # Connect and retrieve key from S3 bucket
-    c = boto.connect_s3(acc_key, acc_sec)
-    b = c.get_bucket(bucket)
-    bucket_key = Key(b)
+# Pages that do not depend on the rankings, rendered once
+static_cache = ResponseCache(lambda: "static")
 
-    bucket_key.key = "top10_bandwidth.json"
-    top10_bandwidth = []
-
-    with open(abs_paths["top10_bandwidth"], "w+") as fp:
-        bucket_key.get_file(fp)
-        fp.seek(0)
-        top10_bandwidth = json.load(fp)
-        fp.close()
-
-    bucket_key.key = "top10_consensus.json"
-    top10_consensus = []
-
-    with open(abs_paths["top10_consensus"], "w+") as fp:
-        bucket_key.get_file(fp)
-        fp.seek(0)
-        top10_consensus = json.load(fp)
-        fp.close()
+# Per-country time series, read a range at a time
+country_history = CountryHistory(strategy=static_store_strategy)
 
-    bucket_key.key = "all.json"
-    all_families = []
-
-    with open(abs_paths["all"], "w+") as fp:
-        bucket_key.get_file(fp)
-        fp.seek(0)
-        all_families = json.load(fp)
-        fp.close()
-
-    all_relays = []
-    for family in all_families:
-        all_relays = all_relays + [relay for relay in family["families"]]
-
-    # Lastly, reset the files for proper file tracking
-    # reset_files()
+@app.route("/", methods=["GET"])
+@response_cache.cached
+def index():
+    top10_bandwidth = ranking_store.get("top10_bandwidth")
+    top10_consensus = ranking_store.get("top10_consensus")
 
+    # Relays are not embedded in the page anymore, autocomplete uses /api/search
     return render_template("index.html", top10_bandwidth=top10_bandwidth,
-        top10_consensus=top10_consensus, all_relays=all_relays)
+        top10_consensus=top10_consensus)
 
 def find_family(fingerprint):
     """
-    Finds a family from the json files based on fingerprint
+    Finds the detail document of a family based on fingerprint
     """
-    # If static_store_strategy is LOCAL, then just lookup local files
-    if static_store_strategy == "LOCAL":
-        print "[find_family] Going local strategy"
-        theOne = ""
-        for key in ["top10_bandwidth.json", "top10_consensus.json", "all.json"]:
-            array_store = []
-
-            with open(abs_paths[key[:-5]], "r") as fp:
-                array_store = json.load(fp)
-                fp.close()
-
-            for family in array_store:
-                for relay in family["families"]:
-                    if relay["fingerprint"] == fingerprint:
-                        theOne = family
-                        break
-
-            if theOne != "":
-                break
-
-        return theOne
-
-    # Fetch latest json files from S3
-    c = boto.connect_s3(acc_key, acc_sec)
-    b = c.get_bucket(bucket)
-    bucket_key = Key(b)
-
-    theOne = ""
-    for key in ["top10_bandwidth.json", "top10_consensus.json", "all.json"]:
-        array_store = []
-        bucket_key.key = key
-
-        # Load the json to the temporary array store
-        with open(abs_paths[key[:-5]], "w+") as fp:
-            bucket_key.get_file(fp)
-            fp.seek(0)
-            array_store = json.load(fp)
-            fp.close()
-
-        # Loop through families to search for the family with given fingerprint
-        for family in array_store:
-            for relay in family["families"]:
-                if relay["fingerprint"] == fingerprint:
-                    theOne = family
-                    break
-
-        if theOne != "":
-            break
-
-    return theOne
+    return ranking_store.find_family_detail(fingerprint)
 
 def reset_files():
     """ Function to make sure local copy of json files are blank """
@@ -139,54 +47,85 @@ def reset_files():
     return
 
 @app.route("/family_detail/<fingerprint>", methods=["GET", "POST"])
+@response_cache.cached
 def family_detail(fingerprint):
     """
     Route for family dashboard page. Searches the json files for the given
     fingerprint. Search for relays are redirected here.
     """
-    theOne = find_family(fingerprint)
+    detail = find_family(fingerprint)
 
     # Family is not found, so return 404 page
-    if theOne == "":
+    if detail == "":
         return render_template("404.html")
 
-    # Preprocess the flags for each relay in the family
-    for relay in theOne["families"]:
-        parse_flags(relay)
-
-    # Set markers for each relay to put on the Google map
-    # Some relays have the same exact locations. Hence each coordinate
-    # stores an array of associated fingerprints
-    markers = {}
-    for relay in theOne["families"]:
-        if "latitude" in relay and "longitude" in relay:
-            if (relay["latitude"], relay["longitude"]) in markers.keys():
-                markers[(relay["latitude"], relay["longitude"])].append(relay["fingerprint"])
-            else:
-                markers[(relay["latitude"], relay["longitude"])] = [relay["fingerprint"]]
-
-    # Reset the json files
-    # reset_files()
-
-    return render_template("family_detail.html", family=theOne, markers=markers)
-
-# Parse the flags key of a relay and assign either a 0 or 1 for each flag
-# This will be used to determine which icon to use in the dashboard
-def parse_flags(relay):
-    res = []
-    for flag in flags:
-        if flag in relay["flags"]:
-            res.append((flag, 1))
-    for flag in flags:
-        if (flag, 1) not in res:
-            res.append((flag, 0))
-    relay["flags"] = res
-    return
+    # Flags and markers are precomputed by relay_rank.py
+    return render_template("family_detail.html", family=detail["family"], markers=detail["markers"])
 
 @app.route("/search", methods=["POST"])
 def search():
-    fingerprint = request.form["fingerprint"]
-    return redirect(url_for("family_detail", fingerprint=fingerprint))
+    """
+    Accepts full or partial fingerprints and nicknames. Redirects to the family
+    of the best match, or to the 404 page if nothing matches
+    """
+    query = request.form["fingerprint"].strip().lstrip("$")
+    if ranking_store.find_shard(query.upper()) is not None:
+        query = query.upper()
+    else:
+        matches = ranking_store.search(query, 1)
+        if len(matches) > 0:
+            query = matches[0]["fingerprint"]
+    return redirect(url_for("family_detail", fingerprint=query))
+
+@app.route("/api/rankings/<metric>", methods=["GET"])
+def api_rankings(metric):
+    """
+    A page of the rankings for one metric, sliced from the rank arrays stored by
+    relay_rank.py. Responses carry an ETag of the ranking snapshot and the page
+    """
+    if metric not in ranking_metrics:
+        return jsonify(error="Unknown metric %s" % metric), 404
+    try:
+        offset = max(int(request.args.get("offset", 0)), 0)
+        limit = min(max(int(request.args.get("limit", 32)), 1), 100)
+    except ValueError:
+        return jsonify(error="offset and limit must be integers"), 400
+
+    rankings = ranking_store.get("rankings")[metric]
+    response = jsonify(metric=metric, offset=offset, limit=limit, total=len(rankings),
+        families=rankings[offset:offset + limit])
+    response.set_etag(hashlib.md5(repr((ranking_store.version(), metric, offset, limit))).hexdigest())
+    response.cache_control.public = True
+    response.cache_control.max_age = 60
+    return response.make_conditional(request)
+
+@app.route("/api/search", methods=["GET"])
+def api_search():
+    """ Prefix search over relay fingerprints and nicknames, used for autocomplete """
+    query = request.args.get("q", "")
+    try:
+        limit = min(int(request.args.get("limit", 10)), 50)
+    except ValueError:
+        limit = 10
+    return jsonify(query=query, results=ranking_store.search(query, limit))
+
+@app.route("/api/country_history/<cc>", methods=["GET"])
+@response_cache.cached
+def api_country_history(cc):
+    """
+    Relay count and consensus weight fraction of a country for each relay_rank.py
+    run, optionally limited to runs between start and end (epoch seconds)
+    """
+    start = request.args.get("start", None, type=int)
+    end = request.args.get("end", None, type=int)
+    if not (len(cc) == 2 and cc.isalpha()):
+        return jsonify(error="Unknown country %s" % cc), 404
+
+    history = country_history.query(cc, start, end)
+    if history is None:
+        return jsonify(error="Unknown country %s" % cc), 404
+    return jsonify(country=cc.upper(), history=[{"time": timestamp, "relay_count": relay_count, "cw_fraction": cw_fraction}
+        for timestamp, relay_count, cw_fraction in history])
 
 # For generating list of badges in /badges
 badges_list = [
@@ -289,9 +228,11 @@ badges_list = [
 ]
 
 @app.route("/badges")
+@static_cache.cached
 def badges():
     return render_template("badges.html", badges_list=badges_list)
 
 @app.route("/faqs")
+@static_cache.cached
 def faqs():
     return render_template("faq.html")
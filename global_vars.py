@@ -7,10 +7,20 @@ acc_key = os.environ["AWS_ACCESS_KEY"]
 acc_sec = os.environ["AWS_SECRET_KEY"]
 bucket = os.environ["AWS_BUCKET"]
 
+# S3-compatible server to upload to instead of AWS, e.g. http://localhost:4567 for a
+# local stand-in. Empty for AWS S3
+s3_endpoint = os.environ.get("ROSTER_S3_ENDPOINT", "")
+
 # Switch for storing static files locally or uploading to S3
 # The value must be either "LOCAL" or "REMOTE"
 static_store_strategy = os.environ["ROSTER_STATIC_STRATEGY"]
 
+# Number of worker processes for the t-shirt eligibility pass. 1 runs it in-process
+tshirt_processes = int(os.environ.get("ROSTER_TSHIRT_PROCESSES", "1"))
+
+# Number of worker processes for computing the badges of each family. 1 runs it in-process
+badge_processes = int(os.environ.get("ROSTER_BADGE_PROCESSES", "1"))
+
 # Script directory
 script_dir = os.path.dirname(__file__)
 
@@ -18,26 +28,48 @@ script_dir = os.path.dirname(__file__)
 rel_paths = {
     "top10_bandwidth": "app/static/json/top10_bandwidth.json",
     "top10_consensus": "app/static/json/top10_consensus.json",
-    "all": "app/static/json/all.json"
+    "all": "app/static/json/all.json",
+    "family_manifest": "app/static/json/family_manifest.json",
+    "family_details": "app/static/json/families",
+    "rankings": "app/static/json/rankings.json",
+    "snapshot": "app/static/json/snapshot.json",
+    "country_history": "app/static/country_history"
 }
 
 # Absolute paths
 abs_paths = {
     "top10_bandwidth": os.path.join(script_dir, rel_paths["top10_bandwidth"]),
     "top10_consensus": os.path.join(script_dir, rel_paths["top10_consensus"]),
-    "all": os.path.join(script_dir, rel_paths["all"])
+    "all": os.path.join(script_dir, rel_paths["all"]),
+    "family_manifest": os.path.join(script_dir, rel_paths["family_manifest"]),
+    "family_details": os.path.join(script_dir, rel_paths["family_details"]),
+    "rankings": os.path.join(script_dir, rel_paths["rankings"]),
+    "snapshot": os.path.join(script_dir, rel_paths["snapshot"]),
+    "country_history": os.path.join(script_dir, rel_paths["country_history"])
+}
+
+# Metrics served by /api/rankings/<metric>, with the family field each one is ranked by
+ranking_metrics = {
+    "bandwidth": "observed_bandwidth",
+    "consensus_weight": "consensus_weight_fraction",
+    "exit_bandwidth": "exit_bandwidth",
+    "age": "first_seen",
+    "uptime": "maximum_uptime",
+    "overall_rank": "overall_rank"
 }
 
 # Database paths
 db_paths = {
     "fingerprint_to_uuid": "app/static/json/fingerprint_to_uuid.json",
-    "uuid_to_family": "app/static/json/uuid_to_family.json"
+    "uuid_to_family": "app/static/json/uuid_to_family.json",
+    "uuid_store": "app/static/json/uuid_store.db"
 }
 
 # Absolute db_paths
 db_abs_paths = {
     "fingerprint_to_uuid": os.path.join(script_dir, db_paths["fingerprint_to_uuid"]),
-    "uuid_to_family": os.path.join(script_dir, db_paths["uuid_to_family"])
+    "uuid_to_family": os.path.join(script_dir, db_paths["uuid_to_family"]),
+    "uuid_store": os.path.join(script_dir, db_paths["uuid_store"])
 }
 
 # Flags for the relays
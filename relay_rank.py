@@ -8,9 +8,15 @@
 from app import app
 from app.controllers.relay_stats_aggregator import RelayStatsAggregator
 from app.controllers.uuid_tagger import add_uuid
+from app.controllers.exit_policy import port_histogram, MAX_PORT
+from app.controllers.network_stats import NetworkStats
+from app.controllers.ranking_snapshot import RankingSnapshot, COUNTRY_GROUPS
 from app.models.family_aggregator import FamilyAggregator
+from app.models.relay import relay_to_json
+from app.models.as_org_lookup import AsOrgLookup
+from app.models.country_history import CountryHistory
 
-import json, os, datetime, csv
+import json, os, sys, datetime, csv
 
 import boto
 from boto.s3.key import Key
@@ -21,11 +27,13 @@ import re, uuid, time, datetime
 
 from global_vars import *
 
-def record_country_stats(relays):
+def record_country_stats(relays, counts=None):
     """
         This function takes an array of relays and records two statistics w.r.t. countries:
         - Distribution of physical relays for each country
         - Distribution of consensus weight for each country
+        If counts is given as a (relay_count, cw_fraction) pair, e.g. from an incremental
+        run, the relays are not counted again
     """
     print "[record_country_stats] Recording country stats"
 
@@ -44,23 +52,31 @@ def record_country_stats(relays):
         cw_fraction[country.alpha2] = 0
 
     # First store data in dict
-    for relay in relays:
-        if "country" in relay:
-            relay_count[relay["country"].upper()] += 1
-            cw_fraction[relay["country"].upper()] += relay.setdefault("consensus_weight_fraction", 0)
+    if counts is not None:
+        for country in relay_count:
+            relay_count[country] = counts[0].get(country, 0)
+            cw_fraction[country] = counts[1].get(country, 0)
+    else:
+        for relay in relays:
+            if "country" in relay:
+                relay_count[relay["country"].upper()] += 1
+                cw_fraction[relay["country"].upper()] += relay.setdefault("consensus_weight_fraction", 0)
 
     # Write data for each stat
-    time = "-".join(datetime.datetime.strftime(datetime.datetime.now(), "%Y, %m, %d, %H, %M, %S").split(", "))
+    run_time = "-".join(datetime.datetime.strftime(datetime.datetime.now(), "%Y, %m, %d, %H, %M, %S").split(", "))
     for path, data in [(relay_count_path, relay_count), (cw_fraction_path, cw_fraction)]:
         with open(path, "a") as f:
             c = csv.writer(f)
-            c.writerow([time] + data.values())
+            c.writerow([run_time] + data.values())
             f.close()
 
+    # Also append to the time series served by /api/country_history/<cc>
+    CountryHistory().append(int(time.time()), relay_count, cw_fraction)
+
     print "[record_country_stats] End record_country_stats"
     return (relay_count, cw_fraction)
 
-def record_country_stats_json(relays):
+def record_country_stats_json(relays, counts=None):
     """
         Same as record_country_stats, but returns data for storing json rather than
         csv. Is used for getting the country stats for guard and exit relays
@@ -76,10 +92,14 @@ def record_country_stats_json(relays):
         cw_fraction[country.alpha2] = 0
 
     # First store data in dict
-    for relay in relays:
-        if "country" in relay:
-            relay_count[relay["country"].upper()] += 1
-            cw_fraction[relay["country"].upper()] += relay.setdefault("consensus_weight_fraction", 0)
+    if counts is not None:
+        relay_count.update(counts[0])
+        cw_fraction.update(counts[1])
+    else:
+        for relay in relays:
+            if "country" in relay:
+                relay_count[relay["country"].upper()] += 1
+                cw_fraction[relay["country"].upper()] += relay.setdefault("consensus_weight_fraction", 0)
 
     print "[record_country_stats_json] end function"
 
@@ -88,63 +108,22 @@ def record_country_stats_json(relays):
         "cw_fraction": OrderedDict(sorted(cw_fraction.items(), key=lambda item: item[1], reverse=True))
     }
 
-# Helper functions for record_port_stats
-def parse_between(string):
-    if "-" in string:
-        res = string.split("-")
-        return [int(res[0]), int(res[1])]
-    return [int(string)]
-
-def get_opposite_offset(num):
-    return (num + (-1)) % 2
-
-def stack_dictionaries(dict1, dict2):
-    for key in dict2:
-        dict1[key] += dict2[key]
-    return
-
 """
     This function takes an array of relays and records the number of times
-    each port is accepted in the exit policy.
+    each port is accepted in the exit policy. An already computed histogram,
+    e.g. from an incremental run, is only stored.
 """
-def record_port_stats(relays):
+def record_port_stats(relays, all_ports=None):
     print "[record_port_stats] Recording port stats"
     script_dir = "app/"
     rel_path = "static/json/ports.json"
     abs_file_path = os.path.join(script_dir, rel_path)
 
-    # Initialization
-    all_ports = {}
-    for i in range(1, 65536):
-        all_ports[i] = 0
-
-    # Offset constants for the loop
-    init_vals = {"accept": 1, "reject": 0}
-
-    # Loop through each relay
-    for relay in relays:
-        policy = relay["exit_policy_summary"].keys()[0]
-        if relay["exit_policy_summary"][policy][0] == "1-65535":
-            continue
-
-        ports, offset_value = relay["exit_policy_summary"][policy], init_vals[policy]
-        opposite_offset = get_opposite_offset(offset_value)
-
-        relay_ports = {}
-        for i in range(1, 65536):
-            relay_ports[i] = opposite_offset
-
-        for interval in relay["exit_policy_summary"][policy]:
-            parsed = parse_between(interval)
-            if len(parsed) == 1:
-                relay_ports[parsed[0]] = offset_value
-            else:
-                for i in range(parsed[0], parsed[1]+1):
-                    relay_ports[i] = offset_value
-        stack_dictionaries(all_ports, relay_ports)
+    if all_ports is None:
+        all_ports = port_histogram(relays)
 
     json_file = open(abs_file_path, "w+")
-    json_file.write(json.dumps(all_ports))
+    json_file.write(json.dumps(dict((port, all_ports[port]) for port in range(1, MAX_PORT + 1))))
     json_file.close()
 
     print "[record_port_stats] End record ports stats"
@@ -213,7 +192,7 @@ def no_exit_or_guard(fingerprints, dict_relays):
     """ Helper function for getting ASes with no guard/exit relays """
     for fingerprint in fingerprints:
         relay = dict_relays[fingerprint]
-        if "Guard" in relay["flags"] or "Exit" in relay["flags"]:
+        if relay.has_flag("Guard") or relay.has_flag("Exit"):
             return False
     return True
 
@@ -221,8 +200,8 @@ def group_by_exit_and_guard(relays):
     """
     Creates two files - AS stats aggregated for exit relays and guard relays
     """
-    exit_as_stats = group_by_AS([relay for relay in relays if "Exit" in relay["flags"]])
-    guard_as_stats = group_by_AS([relay for relay in relays if "Guard" in relay["flags"]])
+    exit_as_stats = group_by_AS([relay for relay in relays if relay.has_flag("Exit")])
+    guard_as_stats = group_by_AS([relay for relay in relays if relay.has_flag("Guard")])
 
     exit_json, guard_json = "exit_as_stats.json", "guard_as_stats.json"
     for filename, json_store in [(exit_json, exit_as_stats), (guard_json, guard_as_stats)]:
@@ -327,70 +306,134 @@ def get_ipv6_regex(address):
     res = re.search(r'\[.*\]', address, re.IGNORECASE)
     return res
 
-def group_by_AS_org_id(relays):
+def record_org_stats(histogram):
     """
-    This function takes the json file "as2orgname.json" and computes
-    a histogram for each AS organization id/name
+    Stores a histogram of relays per AS organization id, as computed by
+    NetworkStats with the AsOrgLookup of the file "as2orgname.json".
 
-    The resulting dictionary would be used to award points and badges to relays
+    The histograms are used to award points and badges to relays
     which point to rare AS organizations.
     """
-    print "[group_by_AS_org_id] Grouping by AS org_id"
+    print "[record_org_stats] Recording AS org_id stats"
     result_file = "app/static/json/as_2_org_histogram.json"
 
-    result_store = {
-        "as_2_org": {},
-        "org_2_hist": {}
-    }
-
-    as2org_store = {}
-    with open("as2orgname.json", "r") as fp:
-        as2org_store = json.load(fp)
+    with open(result_file, "w+") as fp:
+        fp.write(json.dumps(histogram))
         fp.close()
 
-    # now populate the result_store with the org_ids
-    result_store["as_2_org"] = as2org_store
+    print "[record_org_stats] End function"
 
-    # Initialize the org_2_hist with each org_id mapped to zero
-    org_ids = [item[1][0] for item in as2org_store.items()]
-
-    for org_id in org_ids:
-        if org_id not in result_store["org_2_hist"]:
-            result_store["org_2_hist"][org_id] = 0
+def build_rank_arrays(groups):
+    """
+        Turns the sorted rankings into compact arrays served by /api/rankings/<metric>.
+        Each entry only holds what a leaderboard row needs.
+    """
+    sorted_rankings = {
+        "bandwidth": groups["bandwidth_rankings"],
+        "consensus_weight": groups["consensus_rankings"],
+        "exit_bandwidth": groups["exit_bandwidth_rankings"],
+        "age": groups["age_rank"],
+        "uptime": groups["uptime_rank"],
+        "overall_rank": groups["overall_rankings"]
+    }
 
-    # Now loop through relays and create histogram
-    for relay in relays:
-        if "as_number" in relay:
-            as_number = relay["as_number"][2:]
-            if as_number in result_store["as_2_org"]:
-                org_id = result_store["as_2_org"][as_number][0]
-                result_store["org_2_hist"][org_id] += 1
+    rank_arrays = {}
+    for metric, families in sorted_rankings.items():
+        field = ranking_metrics[metric]
+        rank_arrays[metric] = []
+        for family in families:
+            if field == "overall_rank":
+                value = family["badges"]["overall_rank"]
             else:
-                org_id = "Unknown/AS" + str(as_number)
-                result_store["as_2_org"][as_number] = (org_id, org_id)
-                result_store["org_2_hist"][org_id] = 1
-
-    with open(result_file, "w+") as fp:
-        fp.write(json.dumps(result_store))
-        fp.close()
-
-    print "[group_by_AS_org_id] End function"
-
-    return result_store
+                value = family[field]
+            rank_arrays[metric].append({
+                "fingerprint": family["families"][0]["fingerprint"],
+                "nickname": family["families"][0].get("nickname", ""),
+                "contact": family["contact"][0] if len(family["contact"]) > 0 else "",
+                "num_relays": len(family["families"]),
+                "value": value
+            })
+    return rank_arrays
 
 def store_rankings(groups):
     rankings = {"top10_bandwidth": groups["bandwidth_top10"],
                 "top10_consensus": groups["consensus_top10"],
-                "all": groups["families"]}
+                "all": groups["families"],
+                "rankings": build_rank_arrays(groups)}
 
     # Using abs_paths dictionary from global_vars.py
-    for key, path in abs_paths.items():
-        json_file = open(path, "w+")
-        json_file.write(json.dumps(rankings[key]))
+    for key, data in rankings.items():
+        json_file = open(abs_paths[key], "w+")
+        json_file.write(json.dumps(data, default=relay_to_json))
         json_file.close()
 
     return
 
+def parse_flags(relay):
+    """
+        Pairs each flag with 1 if the relay has it and 0 otherwise, present flags first.
+        This is used to determine which icon to use in the dashboard
+    """
+    res = [(flag, 1) for flag in flags if flag in relay["flags"]]
+    res += [(flag, 0) for flag in flags if flag not in relay["flags"]]
+    return res
+
+def group_markers(relays):
+    """
+        Markers for each relay to put on the map. Some relays have the same exact
+        locations, hence each coordinate stores an array of associated fingerprints
+    """
+    markers = OrderedDict()
+    for relay in relays:
+        if "latitude" in relay and "longitude" in relay:
+            markers.setdefault((relay["latitude"], relay["longitude"]), []).append(relay["fingerprint"])
+    return [{"latitude": latitude, "longitude": longitude, "fingerprints": fingerprints}
+            for (latitude, longitude), fingerprints in markers.items()]
+
+def store_family_details(families):
+    """
+        Writes one detail document per family, ready to be rendered by the family
+        dashboard: flags are expanded and map markers are grouped. Documents are named
+        after the family's uuid, which stays the same across runs. Also writes the
+        fingerprint => document manifest used by the views to find them.
+        The new documents are written first, then the manifest is swapped in, and
+        only then are the documents of the previous run that are no longer listed
+        removed, so the manifest never points at a missing document.
+    """
+    print "[store_family_details] Storing family detail documents"
+    detail_dir = abs_paths["family_details"]
+    if not os.path.isdir(detail_dir):
+        os.makedirs(detail_dir)
+
+    manifest = {}
+    for family in families:
+        shard = family["families"][0]["uuid"]
+        detail = dict(family)
+        detail["families"] = []
+        for relay in family["families"]:
+            relay_detail = dict(relay.items())
+            relay_detail["flags"] = parse_flags(relay)
+            detail["families"].append(relay_detail)
+            manifest[relay["fingerprint"]] = shard
+
+        path = os.path.join(detail_dir, shard + ".json")
+        with open(path + ".tmp", "w+") as fp:
+            fp.write(json.dumps({"family": detail, "markers": group_markers(family["families"])}))
+        os.rename(path + ".tmp", path)
+
+    with open(abs_paths["family_manifest"] + ".tmp", "w+") as fp:
+        fp.write(json.dumps(manifest))
+    os.rename(abs_paths["family_manifest"] + ".tmp", abs_paths["family_manifest"])
+
+    # Documents of families that no longer exist
+    shards = set(shard + ".json" for shard in manifest.values())
+    for filename in os.listdir(detail_dir):
+        if filename.endswith(".json") and filename not in shards:
+            os.remove(os.path.join(detail_dir, filename))
+
+    print "[store_family_details] End storing family detail documents"
+    return manifest
+
 ### Main script
 if __name__ == "__main__":
     groups = {"families": [],
@@ -413,20 +456,28 @@ if __name__ == "__main__":
               "org_histogram": {}
              }
 
-    aggregator = FamilyAggregator()
+    # With --incremental, the previous run's snapshot is used to only reprocess
+    # the relays and families that changed. Every run writes a new snapshot
+    snapshot = RankingSnapshot()
+    if "--incremental" in sys.argv and not snapshot.load():
+        print "[relay_rank] No previous snapshot, doing a full run"
+
+    aggregator = FamilyAggregator(snapshot)
     families = aggregator.families
     relays = aggregator.relays
 
-    ### TODO
-    ### Code to add uuid to each relay in each family
-    print "[relay_rank] Getting uuids for each relay"
-    relays = add_uuid("relays", relays)
+    ### Tag every relay with the uuid of its family
     print "[relay_rank] Getting uuids for each family"
-    families = add_uuid("families", families)
+    families = add_uuid(families)
     print "[relay_rank] UUID processing done"
 
-    exit_relays = [relay for relay in relays if "Exit" in relay["flags"]]
-    guard_relays = [relay for relay in relays if "Guard" in relay["flags"]]
+    # Network-wide histograms are computed in one pass over the relays. In incremental
+    # runs the country and port histograms are updated by deltas instead
+    print "[relay_rank] Computing network stats"
+    as_orgs = AsOrgLookup.load()
+    stats = NetworkStats(as_orgs, histograms=not snapshot.incremental).add_relays(relays)
+    exit_relays = stats.relays["Exit"]
+    guard_relays = stats.relays["Guard"]
 
     groups["families"] = families
     groups["relays"] = relays
@@ -437,30 +488,45 @@ if __name__ == "__main__":
     groups["bandwidth_rankings"] = sorted(families, key=lambda family: family["observed_bandwidth"], reverse=True)
     groups["consensus_rankings"] = sorted(families, key=lambda family: family["consensus_weight_fraction"], reverse=True)
     groups["exit_bandwidth_rankings"] = sorted(families, key=lambda family: family["exit_bandwidth"], reverse=True)
-    groups["age_rank"] = sorted(families, key=lambda family: datetime.datetime.strptime(family["first_seen"], "%Y-%m-%d %H:%M:%S"))
-    groups["uptime_rank"] = sorted(families, key=lambda family: datetime.datetime.strptime(family["maximum_uptime"], "%Y-%m-%d %H:%M:%S"))
-    groups["country_count_rankings"], groups["country_cw_rankings"] = record_country_stats(relays)
-    groups["country_exit_rankings"] = record_country_stats_json(exit_relays)
+    # Family timestamps are normalized by FamilyAggregator, and the fixed-width
+    # "%Y-%m-%d %H:%M:%S" format sorts chronologically without parsing
+    groups["age_rank"] = sorted(families, key=lambda family: family["first_seen"])
+    groups["uptime_rank"] = sorted(families, key=lambda family: family["maximum_uptime"])
+
+    if snapshot.incremental:
+        country_counts = dict((group, snapshot.update_country_counts(group)) for group in COUNTRY_GROUPS)
+        port_counts = snapshot.update_port_histogram()
+    else:
+        country_counts = stats.countries
+        port_counts = stats.port_histogram()
+
+    groups["country_count_rankings"], groups["country_cw_rankings"] = record_country_stats(relays, country_counts["all"])
+    groups["country_exit_rankings"] = record_country_stats_json(exit_relays, country_counts["Exit"])
     ####
     ### TODO currently we are sorting the guard and exit rankings by relay count. This can be changed to cw fraction if necessary
     ###
-    groups["country_exit_ordered_by_relay_count"] = sorted([ (country, count) for country, count in groups["country_exit_rankings"]["relay_count"].items() if count != 0 ], key=lambda item: item[1])
-    groups["country_guard_rankings"] = record_country_stats_json(guard_relays)
-    groups["country_guard_ordered_by_relay_count"] = sorted([ (country, count) for country, count in groups["country_guard_rankings"]["relay_count"].items() if count != 0 ], key=lambda item: item[1])
-    groups["port_rankings"] = record_port_stats(relays)
-    groups["org_exit_histogram"] = group_by_AS_org_id(exit_relays)
-    groups["org_exit_ordered"] = sorted( [(org_id, count) for org_id, count in groups["org_exit_histogram"]["org_2_hist"].items() if count != 0], key=lambda item: item[1])
-    groups["org_guard_histogram"] = group_by_AS_org_id(guard_relays)
-    groups["org_guard_ordered"] = sorted( [(org_id, count) for org_id, count in groups["org_guard_histogram"]["org_2_hist"].items() if count != 0], key=lambda item: item[1])
+    groups["country_exit_ordered_by_relay_count"] = sorted([ (country, count) for country, count in groups["country_exit_rankings"]["relay_count"].items() if count != 0 ], key=lambda item: (item[1], item[0]))
+    groups["country_guard_rankings"] = record_country_stats_json(guard_relays, country_counts["Guard"])
+    groups["country_guard_ordered_by_relay_count"] = sorted([ (country, count) for country, count in groups["country_guard_rankings"]["relay_count"].items() if count != 0 ], key=lambda item: (item[1], item[0]))
+    groups["port_rankings"] = record_port_stats(relays, port_counts)
+    groups["as_orgs"] = as_orgs
+    groups["org_exit_histogram"] = stats.orgs["Exit"]
+    groups["org_exit_ordered"] = sorted( [(org_id, count) for org_id, count in groups["org_exit_histogram"]["org_2_hist"].items() if count != 0], key=lambda item: (item[1], item[0]))
+    groups["org_guard_histogram"] = stats.orgs["Guard"]
+    groups["org_guard_ordered"] = sorted( [(org_id, count) for org_id, count in groups["org_guard_histogram"]["org_2_hist"].items() if count != 0], key=lambda item: (item[1], item[0]))
+    # The file used to be written once per flag and kept the guard histogram
+    record_org_stats(groups["org_guard_histogram"])
 
     stats_aggregator = RelayStatsAggregator(groups)
 
-    # Assign badges to each family
+    # Assign badges to each family. Badges hold percentiles over all families
+    # and relays, so they are recomputed on every run
     print "[relay_rank] Assigning badges to each family"
     curr_time = datetime.datetime.utcnow()
-    for family in families:
-        temp = family
-        family["badges"] = stats_aggregator.analyze_family(temp, curr_time)
+    start = time.time()
+    for family, badges in zip(families, stats_aggregator.analyze_families(range(len(families)), curr_time, badge_processes)):
+        family["badges"] = badges
+    print "[relay_rank] Computed badges of %d families in %.1fs" % (len(families), time.time() - start)
     print "[relay_rank] End assigning badges to each family"
 
     # Reassign the groups with updated badges.
@@ -470,6 +536,7 @@ if __name__ == "__main__":
     groups["bandwidth_rankings"] = sorted(families, key=lambda family: family["observed_bandwidth"], reverse=True)
     groups["consensus_rankings"] = sorted(families, key=lambda family: family["consensus_weight_fraction"], reverse=True)
     groups["exit_bandwidth_rankings"] = sorted(families, key=lambda family: family["exit_bandwidth"], reverse=True)
+    groups["overall_rankings"] = sorted(families, key=lambda family: family["badges"]["overall_rank"], reverse=True)
 
     # These are used for the index page
     # Number of relays to show on the front page
@@ -482,10 +549,24 @@ if __name__ == "__main__":
     # Stores bandwidth rankings, consensus_weight rankings, all.json
     print "[relay_rank] Storing rankings"
     store_rankings(groups)
+    store_family_details(families)
     print "[relay_rank] End storing rankings"
 
+    print "[relay_rank] Storing snapshot"
+    snapshot.save(families, groups["port_rankings"], {
+        "all": {"relay_count": groups["country_count_rankings"], "cw_fraction": groups["country_cw_rankings"]},
+        "Exit": groups["country_exit_rankings"],
+        "Guard": groups["country_guard_rankings"]
+    })
+
     if static_store_strategy == "REMOTE":
         # Uploads the data and stats to AWS S3
         print "[relay_rank] Uploading to S3"
         from upload import *
-        map(upload, assets)
+        publisher = S3Publisher()
+        # Detail documents go up before the manifest that points at them, and the
+        # stale ones are only deleted once the new manifest is in place
+        details = family_detail_assets()
+        publisher.publish(details + country_history_assets())
+        publisher.publish(assets)
+        publisher.remove_stale("families/", [key for filename, key in details])
@@ -0,0 +1,12 @@
+"""
+    Tests for the relay_rank.py pipeline. global_vars reads the S3 credentials and
+    the static store strategy from the environment, so placeholders are set before
+    any module of the app is imported.
+"""
+
+import os
+
+os.environ.setdefault("AWS_ACCESS_KEY", "test")
+os.environ.setdefault("AWS_SECRET_KEY", "test")
+os.environ.setdefault("AWS_BUCKET", "test")
+os.environ.setdefault("ROSTER_STATIC_STRATEGY", "LOCAL")
@@ -0,0 +1,138 @@
+"""
+    Checks that an incremental relay_rank.py run produces the same families and
+    network-wide histograms as a full run over the same relays. Two runs of synthetic
+    relays are generated: the second one drops, adds and rewires relays, moves
+    relays to a country the first run did not have, and changes the bandwidth and
+    consensus weight of every relay, as an hourly Onionoo update does.
+"""
+
+import os, json, random, shutil, tempfile, unittest
+
+from app.controllers.network_stats import NetworkStats
+from app.controllers.ranking_snapshot import RankingSnapshot, COUNTRY_GROUPS
+from app.models.as_org_lookup import AsOrgLookup
+from app.models.family_aggregator import FamilyAggregator
+from app.models.relay import Relay
+
+NUM_RELAYS = 200
+COUNTRIES = ["de", "fr", "us", "nl"]
+CONTACTS = ["ops at example dot org", "ops at example dot com", "1BoatSLRHtKNngkdXEeobR76b53LETtpyT bitcoin ops", "abuse@example.net"]
+POLICIES = [{"accept": ["80", "443"]}, {"accept": ["1-1024", "6667"]}, {"reject": ["25", "119-120"]}, {"reject": ["1-65535"]}]
+
+def fingerprint(i):
+    return "%040X" % i
+
+def new_relay(rng, i, num_relays):
+    relay = {"fingerprint": fingerprint(i),
+             "nickname": "relay%d" % i,
+             "flags": rng.sample(["Exit", "Guard", "Fast", "Running"], rng.randint(1, 4)),
+             "country": rng.choice(COUNTRIES),
+             "first_seen": "2015-%02d-01 00:00:00" % rng.randint(1, 12),
+             "last_restarted": "2016-%02d-01 00:00:00" % rng.randint(1, 3),
+             "exit_policy_summary": rng.choice(POLICIES),
+             "effective_family": ["$" + fingerprint(rng.randint(0, num_relays)) + rng.choice(["", "~nick"])
+                                  for _ in range(rng.choice([0, 0, 1, 2]))],
+             "indirect_family": []}
+    contact = rng.choice(CONTACTS + [None])
+    if contact is not None:
+        relay["contact"] = contact
+    return hourly_update(rng, relay)
+
+def hourly_update(rng, relay):
+    relay = dict(relay)
+    relay["observed_bandwidth"] = rng.randint(1, 10 ** 6)
+    relay["consensus_weight"] = rng.randint(1, 10 ** 4)
+    relay["consensus_weight_fraction"] = rng.random() / NUM_RELAYS
+    relay["middle_probability"] = rng.random() / NUM_RELAYS
+    relay["exit_probability"] = rng.random() / NUM_RELAYS
+    return relay
+
+def next_run(rng, previous):
+    """ The relay dicts of the next run """
+    relays = []
+    for relay in previous:
+        if rng.random() < 0.05:
+            continue
+        relay = hourly_update(rng, relay)
+        if rng.random() < 0.05:
+            relay["effective_family"] = ["$" + fingerprint(rng.randint(0, NUM_RELAYS + 20))]
+        if rng.random() < 0.02:
+            relay["country"] = "se"
+        relays.append(relay)
+    relays.extend(new_relay(rng, i, NUM_RELAYS + 20) for i in range(NUM_RELAYS, NUM_RELAYS + 20))
+    rng.shuffle(relays)
+    return relays
+
+def group(relays, snapshot=None):
+    """ Runs the family grouping of FamilyAggregator without fetching from Onionoo """
+    aggregator = object.__new__(FamilyAggregator)
+    aggregator.relays = relays
+    aggregator.snapshot = snapshot
+    aggregator.tshirts = {}
+    if snapshot is not None:
+        snapshot.diff(relays)
+    return aggregator.group_by_family()
+
+def network_stats(relays):
+    return NetworkStats(AsOrgLookup({})).add_relays(relays)
+
+def comparable(families):
+    """ The families as sorted JSON, with members by fingerprint """
+    documents = []
+    for family in families:
+        family = dict(family)
+        family["families"] = [relay["fingerprint"] for relay in family["families"]]
+        # Set to the current time when the family is created
+        del family["last_seen"]
+        documents.append(json.dumps(family, sort_keys=True))
+    return sorted(documents)
+
+def nonzero(counts):
+    return dict((key, value) for key, value in counts.items() if value != 0)
+
+class IncrementalRunTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "snapshot.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def previous_run(self, relays):
+        """ A full run that writes the snapshot, as relay_rank.py does """
+        snapshot = RankingSnapshot(self.path)
+        families = group(relays, snapshot)
+        stats = network_stats(relays)
+        country_counts = dict((group_name, {"relay_count": counts[0], "cw_fraction": counts[1]})
+                              for group_name, counts in stats.countries.items())
+        snapshot.save(families, stats.port_histogram(), country_counts)
+
+    def test_incremental_run_matches_full_run(self):
+        for seed in range(20):
+            rng = random.Random(seed)
+            previous = [new_relay(rng, i, NUM_RELAYS) for i in range(NUM_RELAYS)]
+            self.previous_run([Relay(relay) for relay in previous])
+            current = next_run(rng, previous)
+
+            snapshot = RankingSnapshot(self.path)
+            self.assertTrue(snapshot.load())
+            incremental = group([Relay(relay) for relay in current], snapshot)
+            full_relays = [Relay(relay) for relay in current]
+            full = group(full_relays)
+
+            # Families, with their contacts, bitcoin addresses and sums
+            self.assertEqual(comparable(incremental), comparable(full), "seed %d" % seed)
+
+            # Network-wide histograms
+            stats = network_stats(full_relays)
+            self.assertEqual(snapshot.update_port_histogram(), stats.port_histogram(), "seed %d" % seed)
+            for group_name in COUNTRY_GROUPS:
+                relay_count, cw_fraction = snapshot.update_country_counts(group_name)
+                expected_count, expected_cw = stats.countries[group_name]
+                self.assertEqual(nonzero(relay_count), expected_count, "seed %d" % seed)
+                for country, fraction in expected_cw.items():
+                    self.assertAlmostEqual(cw_fraction[country], fraction, places=9)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+"""
+    Runs OnionooFetcher against a local stand-in for Onionoo that serves the fixture
+    documents with ETag and Last-Modified validators and answers conditional
+    requests with 304 Not Modified.
+"""
+
+import os, json, shutil, tempfile, threading, unittest
+import BaseHTTPServer, SocketServer
+
+from app.models.onionoo_fetcher import OnionooFetcher
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+DOCUMENTS = ["details", "uptime", "bandwidth"]
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), StandInHandler)
+        # document => (body, etag)
+        self.documents = {}
+        for document in DOCUMENTS:
+            with open(os.path.join(FIXTURES, document + ".json"), "r") as fp:
+                self.set_document(document, fp.read())
+        # (document, status) of every request served
+        self.log = []
+        self.lock = threading.Lock()
+
+    def set_document(self, document, body):
+        self.documents[document] = (body, '"%s-%d"' % (document, hash(body) & 0xffffffff))
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        document = self.path.split("?")[0].strip("/")
+        if document not in self.server.documents:
+            self.send_error(404)
+            return
+        body, etag = self.server.documents[document]
+        status = 304 if self.headers.getheader("If-None-Match") == etag else 200
+        with self.server.lock:
+            self.server.log.append((document, status))
+
+        self.send_response(status)
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", "Fri, 01 Apr 2016 12:00:00 GMT")
+        if status == 200:
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if status == 200:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class OnionooFetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.cache_dir = tempfile.mkdtemp()
+        OnionooFetcher.parsed.clear()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+        OnionooFetcher.parsed.clear()
+
+    def fetcher(self):
+        base_url = "http://127.0.0.1:%d" % self.server.server_address[1]
+        return OnionooFetcher(base_url=base_url, cache_dir=self.cache_dir)
+
+    def statuses(self):
+        with self.server.lock:
+            statuses = dict(self.server.log)
+            del self.server.log[:]
+        return statuses
+
+    def test_fetch_all_then_not_modified(self):
+        first = self.fetcher().fetch_all(DOCUMENTS)
+        self.assertEqual(self.statuses(), {"details": 200, "uptime": 200, "bandwidth": 200})
+        self.assertEqual([relay["nickname"] for relay in first["details"]], ["alpha", "beta"])
+        # Only the fields and history periods the pipeline reads are kept
+        self.assertNotIn("hashed_fingerprint", first["details"][0])
+        self.assertEqual(first["uptime"][0]["uptime"].keys(), ["3_months"])
+        self.assertNotIn("read_history", first["bandwidth"][0])
+
+        # Unchanged documents are answered with 304 and not parsed again
+        second = self.fetcher().fetch_all(DOCUMENTS)
+        self.assertEqual(self.statuses(), {"details": 304, "uptime": 304, "bandwidth": 304})
+        for document in DOCUMENTS:
+            self.assertIs(second[document], first[document])
+
+    def test_changed_document_is_parsed_again(self):
+        first = self.fetcher().fetch_all(DOCUMENTS)
+        self.statuses()
+
+        details = json.loads(self.server.documents["details"][0])
+        details["relays"][0]["nickname"] = "gamma"
+        self.server.set_document("details", json.dumps(details))
+
+        second = self.fetcher().fetch_all(DOCUMENTS)
+        self.assertEqual(self.statuses(), {"details": 200, "uptime": 304, "bandwidth": 304})
+        self.assertEqual([relay["nickname"] for relay in second["details"]], ["gamma", "beta"])
+        self.assertIs(second["uptime"], first["uptime"])
+
+    def test_document_without_validators_is_not_memoized(self):
+        fetcher = self.fetcher()
+        fetcher.fetch("details")
+        body_path = fetcher.cache_paths("details")[0]
+
+        # Without a validator the cached body is parsed every time and not kept
+        with open(body_path, "r") as fp:
+            body = fp.read()
+        with open(body_path, "w") as fp:
+            fp.write(body.replace("alpha", "delta"))
+        relays = fetcher.load_cached("details", fetcher.url_for("details"), {})
+        self.assertEqual(relays[0]["nickname"], "delta")
+        self.assertNotIn(fetcher.url_for("details"), OnionooFetcher.parsed)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,21 +1,117 @@
-import boto, os
-from boto.s3.key import Key
+import boto, os, hashlib, mimetypes, urlparse
+from boto.s3.connection import OrdinaryCallingFormat
+from concurrent.futures import ThreadPoolExecutor
 from global_vars import *
 
+# Files larger than this are uploaded in parts of PART_SIZE bytes
+MULTIPART_THRESHOLD = 8 * 1024 * 1024
+PART_SIZE = 8 * 1024 * 1024
+
 assets = [  ("app/static/json/top10_bandwidth.json", "top10_bandwidth.json"),
             ("app/static/json/top10_consensus.json", "top10_consensus.json"),
             ("app/static/json/all.json", "all.json"),
+            ("app/static/json/family_manifest.json", "family_manifest.json"),
+            ("app/static/json/rankings.json", "rankings.json"),
             ("app/static/json/ports.json", "ports.json"),
             ("app/static/csv/country_relay_count.csv", "country_relay_count.csv"),
             ("app/static/csv/country_cw_fraction.csv", "country_cw_fraction.csv")]
 
-def upload(pair):
-    filename, key = pair
-    print "[upload] Uploading " + filename
-    c = boto.connect_s3(acc_key, acc_sec)
-    b = c.get_bucket(bucket)
-    bucket_key = Key(b)
-    bucket_key.key = key
-    bucket_key.set_contents_from_filename(filename)
-    b.set_acl("public-read", key)
-    print "[upload] Uploaded"
+def family_detail_assets():
+    """ Per-family detail documents, uploaded under families/ """
+    detail_dir = rel_paths["family_details"]
+    return [(os.path.join(detail_dir, filename), "families/" + filename)
+            for filename in sorted(os.listdir(detail_dir)) if filename.endswith(".json")]
+
+def country_history_assets():
+    """ Country time series of CountryHistory, uploaded under country_history/ """
+    history_dir = rel_paths["country_history"]
+    if not os.path.isdir(history_dir):
+        return []
+    return [(os.path.join(history_dir, filename), "country_history/" + filename)
+            for filename in sorted(os.listdir(history_dir)) if filename.endswith(".bin")]
+
+def connect_s3():
+    """ Connects to S3, or to the S3-compatible server at s3_endpoint if one is set """
+    if not s3_endpoint:
+        return boto.connect_s3(acc_key, acc_sec)
+    endpoint = urlparse.urlparse(s3_endpoint)
+    return boto.connect_s3(acc_key, acc_sec, host=endpoint.hostname, port=endpoint.port,
+                           is_secure=endpoint.scheme == "https", calling_format=OrdinaryCallingFormat())
+
+def file_etag(filename, multipart_threshold=MULTIPART_THRESHOLD, part_size=PART_SIZE):
+    """
+    The ETag S3 gives the file once uploaded: the MD5 of its contents, or for
+    multipart uploads the MD5 of the parts' MD5s followed by the number of parts
+    """
+    with open(filename, "rb") as fp:
+        if os.path.getsize(filename) <= multipart_threshold:
+            return hashlib.md5(fp.read()).hexdigest()
+        digests = [hashlib.md5(part).digest() for part in iter(lambda: fp.read(part_size), "")]
+    return "%s-%d" % (hashlib.md5("".join(digests)).hexdigest(), len(digests))
+
+class S3Publisher(object):
+    """
+    Uploads (filename, key) pairs to the bucket as public-read objects. Files whose
+    contents already match the remote ETag are skipped, the rest are uploaded by a
+    pool of threads sharing one connection, and large files in parts
+    """
+
+    def __init__(self, bucket_name=bucket, connection=None, max_workers=8,
+                 multipart_threshold=MULTIPART_THRESHOLD, part_size=PART_SIZE):
+        self.connection = connection if connection is not None else connect_s3()
+        self.bucket = self.connection.get_bucket(bucket_name)
+        self.max_workers = max_workers
+        self.multipart_threshold = multipart_threshold
+        self.part_size = part_size
+
+    def remote_etags(self):
+        """ key => ETag of every object in the bucket, from a single listing """
+        return dict((key.name, key.etag.strip('"')) for key in self.bucket.list())
+
+    def publish(self, pairs):
+        """ Uploads the files that changed. Returns the pairs that were uploaded """
+        etags = self.remote_etags()
+        changed = [(filename, key) for filename, key in pairs
+                   if etags.get(key) != file_etag(filename, self.multipart_threshold, self.part_size)]
+        print "[S3Publisher] %d files unchanged, uploading %d" % (len(pairs) - len(changed), len(changed))
+
+        if changed:
+            executor = ThreadPoolExecutor(max_workers=min(self.max_workers, len(changed)))
+            try:
+                list(executor.map(self.upload, changed))
+            finally:
+                executor.shutdown()
+        return changed
+
+    def remove_stale(self, prefix, keys):
+        """ Deletes the objects under prefix that are not in keys. Returns their names """
+        keys = set(keys)
+        stale = [key.name for key in self.bucket.list(prefix=prefix) if key.name not in keys]
+        print "[S3Publisher] Deleting %d stale objects under %s" % (len(stale), prefix)
+        # A multi-object delete takes at most 1000 keys
+        for i in range(0, len(stale), 1000):
+            self.bucket.delete_keys(stale[i:i + 1000])
+        return stale
+
+    def upload(self, pair):
+        filename, key = pair
+        print "[S3Publisher] Uploading " + filename
+        headers = {"Content-Type": mimetypes.guess_type(filename)[0] or "application/octet-stream"}
+        if os.path.getsize(filename) > self.multipart_threshold:
+            self.upload_multipart(filename, key, headers)
+        else:
+            self.bucket.new_key(key).set_contents_from_filename(filename, headers=headers, policy="public-read")
+        print "[S3Publisher] Uploaded " + filename
+
+    def upload_multipart(self, filename, key, headers):
+        size = os.path.getsize(filename)
+        upload = self.bucket.initiate_multipart_upload(key, headers=headers, policy="public-read")
+        try:
+            with open(filename, "rb") as fp:
+                for part, offset in enumerate(range(0, size, self.part_size)):
+                    fp.seek(offset)
+                    upload.upload_part_from_file(fp, part + 1, size=min(self.part_size, size - offset))
+            upload.complete_upload()
+        except:
+            upload.cancel_upload()
+            raise